@@ -0,0 +1,332 @@
+"""Repeatable benchmark scenarios for AmazonMart.
+
+Drives the real app script headlessly (streamlit.testing AppTest) against a database
+filled by generate_data.py, plus a concurrent order-placement load that calls the same
+stored procedure as the Place Order page. Results go to a JSON file that can be
+diffed against a baseline:
+
+    python benchmark/run_benchmark.py run --scale 10k --out results/base.json
+    python benchmark/run_benchmark.py compare results/base.json results/new.json
+
+Each scenario runs in its own process so its peak RSS is measured in isolation. The
+first iteration of every scenario is an untimed warm-up, reported separately as
+cold_ms (connection setup, schema checks and empty caches).
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(HERE, os.pardir, "streamlit.app.py")
+DEFAULT_DSN = os.environ.get("BENCH_DSN", "postgresql+psycopg2://postgres@localhost:5432/amazonmart_bench")
+SEARCH_TERMS = ["", "smart", "book", "eco toys", "pro 1", "zen", "classic home", "max"]
+
+
+# --- Helper: App harness ---
+def app_secrets(dsn, no_cache):
+    url = make_url(dsn)
+    secrets = {
+        "supabase": {
+            "host": url.host or "localhost",
+            "port": url.port or 5432,
+            "database": url.database,
+            "user": url.username or "postgres",
+            "password": url.password or "",
+            "sslmode": url.query.get("sslmode", "disable"),
+        },
+    }
+    if no_cache:
+        secrets["cache"] = {"ttl_seconds": 0}
+    return secrets
+
+
+def open_app(options):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=300)
+    for section, values in app_secrets(options["dsn"], options["no_cache"]).items():
+        at.secrets[section] = values
+    return at
+
+
+def app_errors(at):
+    return len(at.exception) + len(at.error)
+
+
+def timed(fn):
+    started = time.perf_counter()
+    errors = fn()
+    return (time.perf_counter() - started) * 1000, errors
+
+
+# --- Scenarios ---
+# Each returns (cold_ms, [latency_ms, ...], error_count, operations_per_iteration).
+def page_scenario(page, step=None, state=None):
+    # state: widget keys to set before every run (AppTest can't click tabs or expanders)
+    def scenario(options):
+        at = open_app(options)
+
+        def apply_state():
+            for key, value in (state or {}).items():
+                at.session_state[key] = value
+
+        def first():
+            at.run()
+            at.sidebar.selectbox[0].set_value(page)
+            apply_state()
+            at.run()
+            return app_errors(at)
+
+        def again(i):
+            if step:
+                step(at, i)
+            apply_state()
+            at.run()
+            return app_errors(at)
+
+        cold_ms, errors = timed(first)
+        latencies = []
+        for i in range(options["iterations"]):
+            ms, err = timed(lambda: again(i))
+            latencies.append(ms)
+            errors += err
+        return cold_ms, latencies, errors, 1
+
+    return scenario
+
+
+def next_search_term(at, i):
+    search = next(t for t in at.text_input if t.label == "Search Product")
+    search.set_value(SEARCH_TERMS[i % len(SEARCH_TERMS)])
+
+
+def order_placement(options):
+    engine = create_engine(options["dsn"], pool_size=options["writers"], max_overflow=0)
+    with engine.connect() as conn:
+        customers = conn.execute(text("SELECT max(customer_id) FROM customers")).scalar()
+        products = conn.execute(text("SELECT max(product_id) FROM products")).scalar()
+
+    def place(rng):
+        product_ids = sorted(rng.sample(range(1, products + 1), rng.randint(1, 4)))
+        quantities = [rng.randint(1, 3) for _ in product_ids]
+        with engine.begin() as conn:
+            conn.execute(
+                text("CALL PlaceMultiProductOrder(:c, CAST(:p AS INT[]), CAST(:q AS INT[]))"),
+                {"c": rng.randint(1, customers), "p": product_ids, "q": quantities},
+            )
+
+    cold_ms, _ = timed(lambda: place(random.Random(options["seed"])))
+    latencies, errors, lock = [], [0], threading.Lock()
+
+    def writer(n):
+        rng = random.Random(f"{options['seed']}-{n}")
+        for _ in range(options["iterations"]):
+            started = time.perf_counter()
+            try:
+                place(rng)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+            with lock:
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(options["writers"])]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    engine.dispose()
+    return cold_ms, latencies, errors[0], 1
+
+
+SCENARIOS = {
+    "catalog_search": page_scenario("View Products", next_search_term),
+    "order_history": page_scenario("Order History"),
+    "tracking": page_scenario("Track Orders"),
+    "dashboard": page_scenario("Admin Panel", state={
+        "admin_tab": "Dashboard",
+        "dash_customers": True, "dash_orders": True, "dash_products": True, "dash_payments": True,
+    }),
+    "order_placement": order_placement,
+}
+
+
+# --- Runner ---
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_scenario(name, options, queue):
+    try:
+        started = time.perf_counter()
+        cold_ms, latencies, errors, ops = SCENARIOS[name](options)
+        wall = time.perf_counter() - started
+        queue.put({
+            "cold_ms": round(cold_ms, 2),
+            "samples": len(latencies),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "mean_ms": round(statistics.fmean(latencies), 2),
+            "max_ms": round(max(latencies), 2),
+            "throughput_per_s": round(len(latencies) * ops / max(wall - cold_ms / 1000, 1e-9), 2),
+            "errors": errors,
+            # ru_maxrss is KiB on Linux and bytes on macOS.
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                                 / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+        })
+    except Exception as e:
+        queue.put({"failed": f"{type(e).__name__}: {e}"})
+
+
+def environment(options):
+    def git(*cmd):
+        try:
+            return subprocess.run(["git", *cmd], cwd=HERE, capture_output=True, text=True).stdout.strip()
+        except OSError:
+            return None
+
+    engine = create_engine(options["dsn"])
+    with engine.connect() as conn:
+        server = conn.execute(text("SHOW server_version")).scalar()
+        orders = conn.execute(text("SELECT count(*) FROM orders")).scalar()
+    engine.dispose()
+    return {
+        "git_rev": git("rev-parse", "--short", "HEAD"),
+        "git_dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "postgres": server,
+        "orders_in_db": orders,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "options": {k: v for k, v in options.items() if k != "dsn"},
+    }
+
+
+def prepare_schema(options):
+    # The app creates its tables and triggers on first start; migrate.py backfills them
+    open_app(options).run()
+    sys.path.insert(0, os.path.join(HERE, os.pardir))
+    from migrate import migrate
+    migrate(create_engine(options["dsn"]))
+
+
+def run(args):
+    options = {
+        "dsn": args.dsn,
+        "scale": args.scale,
+        "seed": args.seed,
+        "iterations": args.iterations,
+        "writers": args.writers,
+        "no_cache": args.no_cache,
+    }
+    if args.generate:
+        from generate_data import generate
+        generate(create_engine(args.dsn), args.scale, args.seed, reset=True)
+
+    report = {"meta": environment(options), "scenarios": {}}
+    ctx = multiprocessing.get_context("spawn")
+    if args.generate:
+        child = ctx.Process(target=prepare_schema, args=(options,))
+        child.start()
+        child.join()
+        if child.exitcode:
+            raise SystemExit("Schema preparation failed")
+    for name in args.scenarios or SCENARIOS:
+        queue = ctx.Queue()
+        child = ctx.Process(target=run_scenario, args=(name, options, queue))
+        child.start()
+        result = queue.get()
+        child.join()
+        report["scenarios"][name] = result
+        if "failed" in result:
+            print(f"{name:<16} FAILED {result['failed']}")
+        else:
+            print(f"{name:<16} p50 {result['p50_ms']:>8.1f} ms  p95 {result['p95_ms']:>8.1f} ms  "
+                  f"{result['throughput_per_s']:>8.1f}/s  rss {result['peak_rss_mb']:>6.1f} MB  "
+                  f"errors {result['errors']}")
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.out}")
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)["scenarios"]
+    with open(args.new) as f:
+        new = json.load(f)["scenarios"]
+
+    regressions = 0
+    print(f"{'scenario':<16} {'metric':<16} {'base':>10} {'new':>10} {'change':>9}")
+    for name in sorted(base):
+        if "failed" in base[name]:
+            continue
+        # A scenario that stopped running is the worst regression of all, and fast
+        # failures must not pass for a latency win
+        cur = new.get(name)
+        if cur is None or "failed" in cur:
+            regressions += 1
+            print(f"{name:<16} {'-':<16} {'ok':>10} {'missing' if cur is None else 'FAILED':>10} {'':>9}  REGRESSION")
+            continue
+        old_errors, new_errors = base[name].get("errors", 0), cur.get("errors", 0)
+        if new_errors > old_errors:
+            regressions += 1
+            print(f"{name:<16} {'errors':<16} {old_errors:>10} {new_errors:>10} {'':>9}  REGRESSION")
+        for metric, higher_is_better in [("p50_ms", False), ("p95_ms", False), ("p99_ms", False),
+                                         ("peak_rss_mb", False), ("throughput_per_s", True)]:
+            old, value = base[name].get(metric), cur.get(metric)
+            if not old or value is None:
+                continue
+            change = (value - old) / old * 100
+            worse = -change if higher_is_better else change
+            flag = "  REGRESSION" if worse > args.threshold else ""
+            regressions += bool(flag)
+            print(f"{name:<16} {metric:<16} {old:>10.1f} {value:>10.1f} {change:>+8.1f}%{flag}")
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="run the scenarios and write a JSON report")
+    p.add_argument("--dsn", default=DEFAULT_DSN)
+    p.add_argument("--scale", default="10k", help="recorded in the report; with --generate, the data size")
+    p.add_argument("--seed", type=int, default=42, help="seed for generated data and the order load")
+    p.add_argument("--generate", action="store_true", help="(re)generate the dataset before running")
+    p.add_argument("--iterations", type=int, default=30, help="timed iterations per scenario (per writer)")
+    p.add_argument("--writers", type=int, default=8, help="concurrent writers for order_placement")
+    p.add_argument("--no-cache", action="store_true", help="disable the app's read cache (ttl 0)")
+    p.add_argument("--scenario", dest="scenarios", action="append", choices=SCENARIOS)
+    p.add_argument("--out")
+    p.set_defaults(func=run)
+
+    p = sub.add_parser("compare", help="compare two reports and exit 1 on regressions")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=10.0, help="allowed worsening in percent")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+-- Local stand-in for the AmazonMart tables and the PlaceMultiProductOrder procedure,
+-- used by the benchmark. Indexes, rollups and triggers added by the app itself are
+-- created by the app on first run (ensure_schema), exactly as in production.
+
+DROP TABLE IF EXISTS payments, order_items, orders, customers, products CASCADE;
+-- App-maintained derived tables would be stale against fresh data; the app recreates them.
+DROP TABLE IF EXISTS order_lines, order_submissions, customer_totals, product_totals, rollup_watermarks,
+    rollup_customers_daily, rollup_orders_daily, rollup_payments_daily CASCADE;
+
+CREATE TABLE products (
+    product_id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    category TEXT NOT NULL,
+    price NUMERIC(10, 2) NOT NULL CHECK (price >= 0),
+    stock_quantity INT NOT NULL CHECK (stock_quantity >= 0)
+);
+
+CREATE TABLE customers (
+    customer_id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT UNIQUE,
+    city TEXT,
+    country TEXT,
+    registration_date DATE DEFAULT CURRENT_DATE
+);
+
+CREATE TABLE orders (
+    order_id SERIAL PRIMARY KEY,
+    customer_id INT NOT NULL REFERENCES customers (customer_id),
+    order_date TIMESTAMP NOT NULL DEFAULT now(),
+    status TEXT NOT NULL DEFAULT 'Pending'
+);
+
+CREATE TABLE order_items (
+    order_item_id SERIAL PRIMARY KEY,
+    order_id INT NOT NULL REFERENCES orders (order_id),
+    product_id INT NOT NULL REFERENCES products (product_id),
+    quantity INT NOT NULL CHECK (quantity > 0),
+    unit_price NUMERIC(10, 2) NOT NULL
+);
+
+CREATE TABLE payments (
+    payment_id SERIAL PRIMARY KEY,
+    order_id INT NOT NULL REFERENCES orders (order_id),
+    amount NUMERIC(12, 2) NOT NULL,
+    payment_method TEXT NOT NULL,
+    payment_date TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE INDEX idx_orders_customer ON orders (customer_id);
+CREATE INDEX idx_orders_date ON orders (order_date);
+CREATE INDEX idx_payments_order ON payments (order_id);
+
+-- Places one order with several products: validates and decrements stock, records the
+-- line items at the current price and a payment for the total. Runs in the caller's
+-- transaction, so any failure rolls the whole order back.
+CREATE OR REPLACE PROCEDURE PlaceMultiProductOrder(
+    p_customer_id INT,
+    p_product_ids INT[],
+    p_quantities INT[]
+)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_order_id INT;
+    v_total NUMERIC := 0;
+    v_price NUMERIC;
+    v_stock INT;
+BEGIN
+    IF array_length(p_product_ids, 1) IS NULL
+       OR array_length(p_product_ids, 1) <> array_length(p_quantities, 1) THEN
+        RAISE EXCEPTION 'Product and quantity lists must be non-empty and of equal length';
+    END IF;
+
+    INSERT INTO orders (customer_id) VALUES (p_customer_id) RETURNING order_id INTO v_order_id;
+
+    FOR i IN 1 .. array_length(p_product_ids, 1) LOOP
+        SELECT price, stock_quantity INTO v_price, v_stock
+        FROM products WHERE product_id = p_product_ids[i]
+        FOR UPDATE;
+
+        IF v_stock IS NULL THEN
+            RAISE EXCEPTION 'Product % does not exist', p_product_ids[i];
+        ELSIF v_stock < p_quantities[i] THEN
+            RAISE EXCEPTION 'Insufficient stock for product %', p_product_ids[i];
+        END IF;
+
+        UPDATE products SET stock_quantity = stock_quantity - p_quantities[i]
+        WHERE product_id = p_product_ids[i];
+
+        INSERT INTO order_items (order_id, product_id, quantity, unit_price)
+        VALUES (v_order_id, p_product_ids[i], p_quantities[i], v_price);
+
+        v_total := v_total + v_price * p_quantities[i];
+    END LOOP;
+
+    INSERT INTO payments (order_id, amount, payment_method) VALUES (v_order_id, v_total, 'Card');
+END
+$$;
@@ -0,0 +1,212 @@
+"""One-off schema migrations for AmazonMart that are too heavy for app start-up.
+
+The app creates its own tables, functions and triggers when it starts (ensure_schema
+in streamlit.app.py). This script does the slow parts, without holding up order
+placement for more than one batch at a time:
+
+  * builds the indexes on the shop's tables with CREATE INDEX CONCURRENTLY;
+  * backfills the Order History read model (order_lines) in batches;
+  * backfills the customer and product leaderboards in batches.
+
+Start the app once first so its tables and triggers exist, then run
+
+    python migrate.py                  # connects with .streamlit/secrets.toml [supabase]
+    python migrate.py --dsn postgresql+psycopg2://postgres@localhost/amazonmart
+
+Every step can be re-run: built indexes are skipped, and a finished backfill records
+itself in rollup_watermarks and is skipped from then on.
+"""
+
+import argparse
+import os
+import time
+import tomllib
+from urllib.parse import quote_plus
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BATCH_ROWS = 50_000
+RETRYABLE_SQLSTATES = {"40P01", "55P03"}  # deadlock_detected, lock_not_available
+
+INDEXES = [
+    ("idx_products_name_trgm", "ON products USING gin (name gin_trgm_ops)"),
+    ("idx_products_name_prefix", "ON products (lower(name) text_pattern_ops)"),
+    ("idx_customers_name_prefix", "ON customers (lower(name) text_pattern_ops)"),
+    ("idx_customers_email_lower", "ON customers (lower(email))"),
+    ("idx_order_items_order", "ON order_items (order_id)"),
+]
+
+
+def dsn_from_secrets(path):
+    with open(path, "rb") as f:
+        db = tomllib.load(f)["supabase"]
+    return (
+        f"postgresql+psycopg2://{db['user']}:{quote_plus(db['password'])}@{db['host']}:{db['port']}"
+        f"/{db['database']}?sslmode={db.get('sslmode', 'require')}"
+    )
+
+
+def error_message(e):
+    return str(getattr(e, "orig", e)).strip().splitlines()[0]
+
+
+def step(label, fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    print(f"  {label:<36} {time.perf_counter() - t0:7.1f}s  {result or ''}")
+
+
+def in_batches(engine, lock_tables, statement, hi, batch_rows):
+    # Runs statement for (lo, lo + batch_rows] up to hi, one transaction per batch. Each
+    # batch holds SHARE locks on lock_tables: in-flight writers finish before it reads,
+    # and none can commit between its read and its commit, which the triggers keeping
+    # the derived table in step would otherwise miss. Writers wait one batch at most.
+    lo = 0
+    while lo < hi:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("SET LOCAL lock_timeout = '10s'"))
+                conn.execute(text(f"LOCK TABLE {', '.join(lock_tables)} IN SHARE MODE"))
+                conn.execute(text(statement), {"lo": lo, "hi": min(lo + batch_rows, hi)})
+        except DBAPIError as e:
+            if getattr(e.orig, "pgcode", None) in RETRYABLE_SQLSTATES:
+                time.sleep(1)
+                continue
+            raise
+        lo += batch_rows
+
+
+def require_app_schema(engine):
+    with engine.connect() as conn:
+        ready = conn.execute(text("""
+            SELECT to_regclass('order_lines') IS NOT NULL
+               AND to_regclass('leaderboard_drift') IS NOT NULL
+               AND EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_order_items_order_lines')
+        """)).scalar()
+    if not ready:
+        raise SystemExit("The app's tables and triggers are missing; start the app once, then run this again.")
+
+
+def build_indexes(engine):
+    built = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        try:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        except DBAPIError as e:
+            print(f"  pg_trgm unavailable, its index is skipped: {error_message(e)}")
+        for name, definition in INDEXES:
+            valid = conn.execute(
+                text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {"name": name}
+            ).scalar()
+            if valid:
+                continue
+            if valid is False:
+                # Left behind by an interrupted concurrent build
+                conn.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+            try:
+                conn.execute(text(f"CREATE INDEX CONCURRENTLY {name} {definition}"))
+                built.append(name)
+            except DBAPIError as e:
+                print(f"  {name} not built: {error_message(e)}")
+    return f"built {', '.join(built)}" if built else "all present"
+
+
+def backfill_order_lines(engine, batch_rows):
+    with engine.connect() as conn:
+        if conn.execute(text("SELECT 1 FROM rollup_watermarks WHERE source = 'order_lines'")).scalar():
+            return "already done"
+        # Lines above hi are added by the triggers, which are in place already
+        hi = conn.execute(text("SELECT COALESCE(MAX(order_item_id), 0) FROM order_items")).scalar()
+    in_batches(engine, ["orders", "products", "order_items", "customers"], """
+        INSERT INTO order_lines (order_item_id, order_id, order_date, status, customer_id, customer,
+                                 product_id, product, quantity, unit_price)
+        SELECT oi.order_item_id, o.order_id, o.order_date, o.status, o.customer_id, c.name,
+               oi.product_id, p.name, oi.quantity, oi.unit_price
+        FROM order_items oi
+        JOIN orders o ON o.order_id = oi.order_id
+        JOIN customers c ON c.customer_id = o.customer_id
+        JOIN products p ON p.product_id = oi.product_id
+        WHERE oi.order_item_id > :lo AND oi.order_item_id <= :hi
+        ON CONFLICT (order_item_id) DO NOTHING
+    """, hi, batch_rows)
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                INSERT INTO rollup_watermarks (source, last_id, refreshed_at) VALUES ('order_lines', :hi, now())
+                ON CONFLICT (source) DO NOTHING
+            """),
+            {"hi": hi}
+        )
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("ANALYZE order_lines"))
+    return f"{hi:,} order items"
+
+
+def backfill_leaderboards(engine, batch_rows):
+    # The triggers have counted every write since the totals tables were created, so
+    # the backfill adds what the leaderboard_drift view says is missing. The drift is
+    # read once, in one snapshot and without locks, then added in batches; writes
+    # committed in between change both sides alike and are kept.
+    with engine.connect() as conn:
+        if conn.execute(text("SELECT 1 FROM rollup_watermarks WHERE source = 'leaderboards'")).scalar():
+            return "already done"
+        conn.execute(text("""
+            CREATE TEMP TABLE leaderboard_backfill AS
+            SELECT row_number() OVER (ORDER BY entity, id) AS n, entity, id, total, expected - stored AS delta
+            FROM leaderboard_drift
+        """))
+        conn.commit()
+        rows = conn.execute(text("SELECT COUNT(*) FROM leaderboard_backfill")).scalar()
+        conn.commit()
+        lo = 0
+        while lo < rows:
+            try:
+                with conn.begin():
+                    conn.execute(
+                        text("""
+                            SELECT add_leaderboard_drift(array_agg(entity), array_agg(id), array_agg(total), array_agg(delta))
+                            FROM leaderboard_backfill WHERE n > :lo AND n <= :hi
+                        """),
+                        {"lo": lo, "hi": lo + batch_rows}
+                    )
+            except DBAPIError as e:
+                if getattr(e.orig, "pgcode", None) in RETRYABLE_SQLSTATES:
+                    time.sleep(1)
+                    continue
+                raise
+            lo += batch_rows
+        with conn.begin():
+            conn.execute(text("""
+                INSERT INTO rollup_watermarks (source, last_id, refreshed_at) VALUES ('leaderboards', 0, now())
+                ON CONFLICT (source) DO NOTHING
+            """))
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("ANALYZE customer_totals"))
+        conn.execute(text("ANALYZE product_totals"))
+    return f"{rows:,} totals corrected"
+
+
+def migrate(engine, batch_rows=BATCH_ROWS):
+    started = time.perf_counter()
+    require_app_schema(engine)
+    print("Migrating:")
+    step("indexes (concurrently)", build_indexes, engine)
+    step("order_lines backfill", backfill_order_lines, engine, batch_rows)
+    step("leaderboards backfill", backfill_leaderboards, engine, batch_rows)
+    print(f"Done in {time.perf_counter() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dsn", default=os.environ.get("AMAZONMART_DSN"),
+                        help="defaults to [supabase] in .streamlit/secrets.toml")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="rows per backfill transaction")
+    args = parser.parse_args()
+    dsn = args.dsn or dsn_from_secrets(os.path.join(HERE, ".streamlit", "secrets.toml"))
+    migrate(create_engine(dsn), args.batch_rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,63 @@
 import pandas as pd
 import streamlit as st
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from urllib.parse import quote_plus
-from io import BytesIO
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
+import contextvars
+import csv
 import datetime
+import decimal
+import glob
+import json
+import os
+import queue
+import io
+import logging
+import re
+import select
+import shutil
+import tempfile
+import threading
+import time
+import uuid
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+import duckdb
 
 # --- Database Connection ---
-@st.cache_resource
-def get_engine():
+# Pool settings come from the connection's own secrets section, then [database]:
+#   pool_size, max_overflow, pool_timeout, pool_recycle (seconds), pool_pre_ping
+def connect(section):
     try:
-        host = st.secrets["supabase"]["host"]
-        port = st.secrets["supabase"]["port"]
-        database = st.secrets["supabase"]["database"]
-        user = st.secrets["supabase"]["user"]
-        password = st.secrets["supabase"]["password"]
+        secrets = st.secrets[section]
+        host = secrets["host"]
+        port = secrets["port"]
+        database = secrets["database"]
+        user = secrets["user"]
+        password = secrets["password"]
+        sslmode = secrets.get("sslmode", "require")  # "disable" for a local Postgres
+
+        def pool_setting(key, default):
+            return secrets.get(key, st.secrets.get("database", {}).get(key, default))
 
         encoded_password = quote_plus(password)
         DATABASE_URL = (
-            f"postgresql+psycopg2://{user}:{encoded_password}@{host}:{port}/{database}?sslmode=require"
+            f"postgresql+psycopg2://{user}:{encoded_password}@{host}:{port}/{database}?sslmode={sslmode}"
         )
 
-        return create_engine(DATABASE_URL)
+        return create_engine(
+            DATABASE_URL,
+            pool_size=int(pool_setting("pool_size", 5)),
+            max_overflow=int(pool_setting("max_overflow", 10)),
+            pool_timeout=float(pool_setting("pool_timeout", 30)),
+            # Supabase's pooler drops idle connections; recycle and ping before they bite
+            pool_recycle=int(pool_setting("pool_recycle", 1800)),
+            pool_pre_ping=bool(pool_setting("pool_pre_ping", True)),
+        )
 
     except KeyError as e:
         st.error(f"Missing secret key: {e}")
@@ -30,39 +66,2255 @@ def get_engine():
         st.error(f"Database connection error: {e}")
         st.stop()
 
+@st.cache_resource
+def get_engine():
+    return connect("supabase")
+
+@st.cache_resource
+def get_read_engine():
+    # Optional read replica ([supabase_replica], same keys as [supabase]) for listings,
+    # dashboards and exports. Without one, reads share the primary engine.
+    if "supabase_replica" not in st.secrets:
+        return get_engine()
+    return connect("supabase_replica")
+
 engine = get_engine()
+read_engine = get_read_engine()
+
+# --- Schema Extras: tables, functions and triggers the app maintains ---
+# Runs on every start, so it only holds statements that are cheap once applied. Tables,
+# their indexes (in practice built while the table is new and empty) and triggers are
+# created only when missing: even a no-op CREATE INDEX or CREATE OR REPLACE TRIGGER
+# queues behind in-flight writers of its table. Index builds on the shop's own tables
+# and backfills of the derived tables are one-off steps in migrate.py.
+# Each statement runs in its own transaction so a missing privilege only disables the
+# feature that needs it.
+def index_if_missing(name, definition):
+    return f"""
+    DO $do$
+    BEGIN
+        IF to_regclass('{name}') IS NULL THEN
+            CREATE INDEX {name} {definition};
+        END IF;
+    END
+    $do$
+    """
+
+def view_if_missing(name, query):
+    # CREATE OR REPLACE VIEW would queue behind a long read of the view on every start
+    return f"""
+    DO $do$
+    BEGIN
+        IF to_regclass('{name}') IS NULL THEN
+            CREATE VIEW {name} AS {query};
+        END IF;
+    END
+    $do$
+    """
+
+def trigger_if_missing(name, definition):
+    # A changed definition needs DROP TRIGGER first; functions are replaced on every start
+    table = re.search(r"\bON\s+(\w+)", definition).group(1)
+    return f"""
+    DO $do$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = '{name}' AND tgrelid = '{table}'::regclass) THEN
+            CREATE TRIGGER {name} {definition};
+        END IF;
+    END
+    $do$
+    """
+
+# Held exclusively by refresh_rollups() and rebuild_rollups(), and shared by the rollup
+# triggers below
+ROLLUP_LOCK_KEY = 72_160_301
+
+SCHEMA_DDL = [
+    # Dashboard rollups, folded in incrementally by refresh_rollups()
+    """
+    CREATE TABLE IF NOT EXISTS rollup_watermarks (
+        source TEXT PRIMARY KEY,
+        last_id BIGINT NOT NULL DEFAULT 0,
+        pending_id BIGINT,
+        pending_xmax BIGINT,
+        refreshed_at TIMESTAMPTZ
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_customers_daily (
+        day DATE,
+        country TEXT,
+        city TEXT,
+        new_customers BIGINT NOT NULL,
+        UNIQUE NULLS NOT DISTINCT (day, country, city)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_orders_daily (
+        day DATE,
+        status TEXT,
+        num_orders BIGINT NOT NULL,
+        UNIQUE NULLS NOT DISTINCT (day, status)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_payments_daily (
+        day DATE,
+        payment_method TEXT,
+        num_payments BIGINT NOT NULL,
+        revenue NUMERIC NOT NULL,
+        UNIQUE NULLS NOT DISTINCT (day, payment_method)
+    )
+    """,
+    # Updates and deletes of rows a refresh has already folded in move them between
+    # rollup buckets (-1 from the old, +1 to the new). Rows above the watermark are left
+    # to the next refresh, which reads their current values. The shared lock makes the
+    # watermark check and a concurrent refresh see each other: a refresh waits for this
+    # transaction to commit before it reads, or has committed its watermark before this
+    # reads it.
+    f"""
+    CREATE OR REPLACE FUNCTION rollup_folded(p_source TEXT, p_id BIGINT) RETURNS boolean LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_advisory_xact_lock_shared({ROLLUP_LOCK_KEY});
+        RETURN p_id <= COALESCE((SELECT last_id FROM rollup_watermarks WHERE source = p_source), 0);
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION rollup_move_customer() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF NOT rollup_folded('customers', OLD.customer_id) THEN
+            RETURN NULL;
+        END IF;
+        INSERT INTO rollup_customers_daily AS r (day, country, city, new_customers)
+        VALUES (OLD.registration_date, OLD.country, OLD.city, -1)
+        ON CONFLICT (day, country, city) DO UPDATE SET new_customers = r.new_customers + EXCLUDED.new_customers;
+        IF TG_OP = 'UPDATE' THEN
+            INSERT INTO rollup_customers_daily AS r (day, country, city, new_customers)
+            VALUES (NEW.registration_date, NEW.country, NEW.city, 1)
+            ON CONFLICT (day, country, city) DO UPDATE SET new_customers = r.new_customers + EXCLUDED.new_customers;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    trigger_if_missing("trg_customers_rollup", """
+    AFTER UPDATE OF registration_date, country, city OR DELETE ON customers
+    FOR EACH ROW EXECUTE FUNCTION rollup_move_customer()
+    """),
+    """
+    CREATE OR REPLACE FUNCTION rollup_move_order() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF NOT rollup_folded('orders', OLD.order_id) THEN
+            RETURN NULL;
+        END IF;
+        INSERT INTO rollup_orders_daily AS r (day, status, num_orders)
+        VALUES (OLD.order_date::date, OLD.status, -1)
+        ON CONFLICT (day, status) DO UPDATE SET num_orders = r.num_orders + EXCLUDED.num_orders;
+        IF TG_OP = 'UPDATE' THEN
+            INSERT INTO rollup_orders_daily AS r (day, status, num_orders)
+            VALUES (NEW.order_date::date, NEW.status, 1)
+            ON CONFLICT (day, status) DO UPDATE SET num_orders = r.num_orders + EXCLUDED.num_orders;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    trigger_if_missing("trg_orders_rollup", """
+    AFTER UPDATE OF order_date, status OR DELETE ON orders
+    FOR EACH ROW EXECUTE FUNCTION rollup_move_order()
+    """),
+    """
+    CREATE OR REPLACE FUNCTION rollup_move_payment() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF NOT rollup_folded('payments', OLD.payment_id) THEN
+            RETURN NULL;
+        END IF;
+        INSERT INTO rollup_payments_daily AS r (day, payment_method, num_payments, revenue)
+        VALUES (OLD.payment_date::date, OLD.payment_method, -1, -COALESCE(OLD.amount, 0))
+        ON CONFLICT (day, payment_method)
+        DO UPDATE SET num_payments = r.num_payments + EXCLUDED.num_payments, revenue = r.revenue + EXCLUDED.revenue;
+        IF TG_OP = 'UPDATE' THEN
+            INSERT INTO rollup_payments_daily AS r (day, payment_method, num_payments, revenue)
+            VALUES (NEW.payment_date::date, NEW.payment_method, 1, COALESCE(NEW.amount, 0))
+            ON CONFLICT (day, payment_method)
+            DO UPDATE SET num_payments = r.num_payments + EXCLUDED.num_payments, revenue = r.revenue + EXCLUDED.revenue;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    trigger_if_missing("trg_payments_rollup", """
+    AFTER UPDATE OF payment_date, payment_method, amount OR DELETE ON payments
+    FOR EACH ROW EXECUTE FUNCTION rollup_move_payment()
+    """),
+    # Push notifications for Track Orders' live mode
+    """
+    CREATE OR REPLACE FUNCTION notify_new_order() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('new_orders', NEW.order_id::text);
+        RETURN NEW;
+    END
+    $$
+    """,
+    trigger_if_missing("trg_orders_notify", """
+    AFTER INSERT ON orders
+    FOR EACH ROW EXECUTE FUNCTION notify_new_order()
+    """),
+    # Order History read model: one denormalised row per order line, kept in step with
+    # its source tables by triggers, so browsing history never re-joins them
+    """
+    CREATE TABLE IF NOT EXISTS order_lines (
+        order_item_id INT PRIMARY KEY,
+        order_id INT NOT NULL,
+        order_date TIMESTAMP NOT NULL,
+        status TEXT,
+        customer_id INT NOT NULL,
+        customer TEXT,
+        product_id INT NOT NULL,
+        product TEXT,
+        quantity INT NOT NULL,
+        unit_price NUMERIC NOT NULL
+    )
+    """,
+    index_if_missing("idx_order_lines_recent", "ON order_lines (order_date DESC, order_id DESC, order_item_id DESC)"),
+    index_if_missing("idx_order_lines_customer", "ON order_lines (customer_id, order_date DESC, order_id DESC, order_item_id DESC)"),
+    index_if_missing("idx_order_lines_product", "ON order_lines (product_id, order_date DESC, order_id DESC, order_item_id DESC)"),
+    index_if_missing("idx_order_lines_status", "ON order_lines (status, order_date DESC, order_id DESC, order_item_id DESC)"),
+    """
+    CREATE OR REPLACE FUNCTION sync_order_lines_item() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM order_lines WHERE order_item_id = OLD.order_item_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO order_lines (order_item_id, order_id, order_date, status, customer_id, customer,
+                                     product_id, product, quantity, unit_price)
+            SELECT NEW.order_item_id, o.order_id, o.order_date, o.status, o.customer_id, c.name,
+                   NEW.product_id, p.name, NEW.quantity, NEW.unit_price
+            FROM orders o
+            JOIN customers c ON c.customer_id = o.customer_id
+            JOIN products p ON p.product_id = NEW.product_id
+            WHERE o.order_id = NEW.order_id
+            ON CONFLICT (order_item_id) DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    trigger_if_missing("trg_order_items_order_lines", """
+    AFTER INSERT OR UPDATE OR DELETE ON order_items
+    FOR EACH ROW EXECUTE FUNCTION sync_order_lines_item()
+    """),
+    """
+    CREATE OR REPLACE FUNCTION sync_order_lines_order() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE order_lines
+        SET order_date = NEW.order_date,
+            status = NEW.status,
+            customer_id = NEW.customer_id,
+            customer = (SELECT name FROM customers WHERE customer_id = NEW.customer_id)
+        WHERE order_id = NEW.order_id;
+        RETURN NULL;
+    END
+    $$
+    """,
+    trigger_if_missing("trg_orders_order_lines", """
+    AFTER UPDATE OF order_date, status, customer_id ON orders
+    FOR EACH ROW EXECUTE FUNCTION sync_order_lines_order()
+    """),
+    """
+    CREATE OR REPLACE FUNCTION sync_order_lines_names() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'customers' THEN
+            UPDATE order_lines SET customer = NEW.name WHERE customer_id = NEW.customer_id;
+        ELSE
+            UPDATE order_lines SET product = NEW.name WHERE product_id = NEW.product_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    trigger_if_missing("trg_customers_order_lines", """
+    AFTER UPDATE OF name ON customers
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name) EXECUTE FUNCTION sync_order_lines_names()
+    """),
+    trigger_if_missing("trg_products_order_lines", """
+    AFTER UPDATE OF name ON products
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name) EXECUTE FUNCTION sync_order_lines_names()
+    """),
+    # Leaderboards: running totals per customer and product, adjusted by triggers in the
+    # same transaction as the rows they count. Top-N reads walk the total's index.
+    """
+    CREATE TABLE IF NOT EXISTS customer_totals (
+        customer_id INT PRIMARY KEY,
+        total_spending NUMERIC NOT NULL DEFAULT 0,
+        total_orders BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    index_if_missing("idx_customer_totals_spending", "ON customer_totals (total_spending DESC, customer_id)"),
+    index_if_missing("idx_customer_totals_orders", "ON customer_totals (total_orders DESC, customer_id)"),
+    """
+    CREATE TABLE IF NOT EXISTS product_totals (
+        product_id INT PRIMARY KEY,
+        total_sold BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    index_if_missing("idx_product_totals_sold", "ON product_totals (total_sold DESC, product_id)"),
+    """
+    CREATE OR REPLACE FUNCTION add_customer_totals(p_customer_id INT, p_spending NUMERIC, p_orders BIGINT)
+    RETURNS void LANGUAGE sql AS $$
+        INSERT INTO customer_totals AS t (customer_id, total_spending, total_orders)
+        VALUES (p_customer_id, p_spending, p_orders)
+        ON CONFLICT (customer_id) DO UPDATE
+        SET total_spending = t.total_spending + EXCLUDED.total_spending,
+            total_orders = t.total_orders + EXCLUDED.total_orders
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION sync_totals_order() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        -- An order moving to another customer takes its payments along
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM add_customer_totals(OLD.customer_id,
+                -COALESCE((SELECT SUM(amount) FROM payments WHERE order_id = OLD.order_id), 0), -1);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM add_customer_totals(NEW.customer_id,
+                COALESCE((SELECT SUM(amount) FROM payments WHERE order_id = NEW.order_id), 0), 1);
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    trigger_if_missing("trg_orders_totals", """
+    AFTER INSERT OR DELETE ON orders
+    FOR EACH ROW EXECUTE FUNCTION sync_totals_order()
+    """),
+    trigger_if_missing("trg_orders_totals_customer", """
+    AFTER UPDATE OF customer_id ON orders
+    FOR EACH ROW WHEN (OLD.customer_id IS DISTINCT FROM NEW.customer_id) EXECUTE FUNCTION sync_totals_order()
+    """),
+    """
+    CREATE OR REPLACE FUNCTION sync_totals_payment() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM add_customer_totals(customer_id, -COALESCE(OLD.amount, 0), 0)
+            FROM orders WHERE order_id = OLD.order_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM add_customer_totals(customer_id, COALESCE(NEW.amount, 0), 0)
+            FROM orders WHERE order_id = NEW.order_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    trigger_if_missing("trg_payments_totals", """
+    AFTER INSERT OR UPDATE OF order_id, amount OR DELETE ON payments
+    FOR EACH ROW EXECUTE FUNCTION sync_totals_payment()
+    """),
+    """
+    CREATE OR REPLACE FUNCTION sync_totals_item() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE product_totals SET total_sold = total_sold - OLD.quantity WHERE product_id = OLD.product_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO product_totals AS t (product_id, total_sold)
+            VALUES (NEW.product_id, NEW.quantity)
+            ON CONFLICT (product_id) DO UPDATE SET total_sold = t.total_sold + EXCLUDED.total_sold;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    trigger_if_missing("trg_order_items_totals", """
+    AFTER INSERT OR UPDATE OF product_id, quantity OR DELETE ON order_items
+    FOR EACH ROW EXECUTE FUNCTION sync_totals_item()
+    """),
+    # Stored totals that differ from the raw tables. Rows being written are either in
+    # both or in neither within one snapshot, so expected - stored stays the right
+    # correction until it is applied, without blocking writers.
+    view_if_missing("leaderboard_drift", """
+    WITH pay AS (
+        SELECT order_id, SUM(amount) AS amount FROM payments GROUP BY order_id
+    ), customers_expected AS (
+        SELECT o.customer_id, COALESCE(SUM(pay.amount), 0) AS total_spending, COUNT(*) AS total_orders
+        FROM orders o LEFT JOIN pay ON pay.order_id = o.order_id
+        GROUP BY o.customer_id
+    ), products_expected AS (
+        SELECT product_id, SUM(quantity) AS total_sold FROM order_items GROUP BY product_id
+    ), customers_compared AS (
+        SELECT customer_id,
+               COALESCE(t.total_spending, 0) AS stored_spending, COALESCE(e.total_spending, 0) AS expected_spending,
+               COALESCE(t.total_orders, 0) AS stored_orders, COALESCE(e.total_orders, 0) AS expected_orders
+        FROM customer_totals t FULL JOIN customers_expected e USING (customer_id)
+    )
+    SELECT 'customer' AS entity, customer_id AS id, 'total_spending' AS total,
+           stored_spending::numeric AS stored, expected_spending::numeric AS expected
+    FROM customers_compared WHERE stored_spending <> expected_spending
+    UNION ALL
+    SELECT 'customer', customer_id, 'total_orders', stored_orders, expected_orders
+    FROM customers_compared WHERE stored_orders <> expected_orders
+    UNION ALL
+    SELECT 'product', product_id, 'total_sold', COALESCE(t.total_sold, 0), COALESCE(e.total_sold, 0)
+    FROM product_totals t FULL JOIN products_expected e USING (product_id)
+    WHERE COALESCE(t.total_sold, 0) <> COALESCE(e.total_sold, 0)
+    """),
+    # Adds corrections to the totals rather than overwriting them, so writes committed
+    # since the drift was read are kept. Customer rows are locked in id order.
+    """
+    CREATE OR REPLACE FUNCTION add_leaderboard_drift(p_entity TEXT[], p_id INT[], p_total TEXT[], p_delta NUMERIC[])
+    RETURNS void LANGUAGE sql AS $$
+        INSERT INTO customer_totals AS t (customer_id, total_spending, total_orders)
+        SELECT id, COALESCE(SUM(delta) FILTER (WHERE total = 'total_spending'), 0),
+               COALESCE(SUM(delta) FILTER (WHERE total = 'total_orders'), 0)
+        FROM unnest(p_entity, p_id, p_total, p_delta) AS d(entity, id, total, delta)
+        WHERE entity = 'customer'
+        GROUP BY id ORDER BY id
+        ON CONFLICT (customer_id) DO UPDATE
+        SET total_spending = t.total_spending + EXCLUDED.total_spending,
+            total_orders = t.total_orders + EXCLUDED.total_orders;
+        INSERT INTO product_totals AS t (product_id, total_sold)
+        SELECT id, SUM(delta)
+        FROM unnest(p_entity, p_id, p_total, p_delta) AS d(entity, id, total, delta)
+        WHERE entity = 'product'
+        GROUP BY id ORDER BY id
+        ON CONFLICT (product_id) DO UPDATE SET total_sold = t.total_sold + EXCLUDED.total_sold;
+    $$
+    """,
+    # Place Order submissions, keyed by the session's idempotency key
+    """
+    CREATE TABLE IF NOT EXISTS order_submissions (
+        idempotency_key TEXT PRIMARY KEY,
+        customer_id INT NOT NULL,
+        product_ids INT[] NOT NULL,
+        quantities INT[] NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        order_id INT,
+        attempts INT NOT NULL DEFAULT 0,
+        error TEXT,
+        submitted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        finished_at TIMESTAMPTZ
+    )
+    """,
+    index_if_missing("idx_order_submissions_queued", "ON order_submissions (submitted_at) WHERE status = 'queued'"),
+    # Bulk import: whether a staged text value casts to the column's type, so a bad row
+    # is rejected on its own instead of failing the merge. Postgres 16+ checks without
+    # a subtransaction per value.
+    """
+    DO $do$
+    BEGIN
+        IF current_setting('server_version_num')::int >= 160000 THEN
+            CREATE OR REPLACE FUNCTION import_value_ok(p_value TEXT, p_type TEXT) RETURNS boolean
+            LANGUAGE sql STABLE AS 'SELECT pg_input_is_valid(p_value, p_type)';
+        ELSE
+            CREATE OR REPLACE FUNCTION import_value_ok(p_value TEXT, p_type TEXT) RETURNS boolean
+            LANGUAGE plpgsql STABLE AS $fn$
+            BEGIN
+                EXECUTE format('SELECT %L::%s', p_value, p_type);
+                RETURN true;
+            EXCEPTION WHEN data_exception THEN
+                RETURN false;
+            END
+            $fn$;
+        END IF;
+    END
+    $do$
+    """,
+]
+
+@st.cache_resource
+def ensure_schema():
+    failures = []
+    for ddl in SCHEMA_DDL:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(ddl))
+        except Exception as e:
+            failures.append((ddl, e))
+    return failures
+
+schema_failures = ensure_schema()
+if schema_failures:
+    with st.sidebar.expander(f"⚠️ {len(schema_failures)} schema setup step(s) failed"):
+        for ddl, e in schema_failures:
+            st.caption(f"`{ddl}`: {getattr(e, 'orig', e)}")
+
+# Derived tables that are only complete once migrate.py has backfilled them; each
+# backfill leaves a rollup_watermarks row behind when it finishes
+MIGRATION_MARKERS = {"order_lines": "Order History", "leaderboards": "Leaderboards"}
+
+@st.cache_data(ttl=600)
+def pending_migrations():
+    try:
+        with engine.connect() as conn:
+            done = set(conn.execute(
+                text("SELECT source FROM rollup_watermarks WHERE source = ANY(:sources)"),
+                {"sources": list(MIGRATION_MARKERS)}
+            ).scalars())
+    except Exception:
+        return []
+    return [feature for marker, feature in MIGRATION_MARKERS.items() if marker not in done]
+
+if pending_migrations():
+    st.sidebar.warning(
+        f"⚠️ Not backfilled yet: {', '.join(pending_migrations())}. Run `python migrate.py` once."
+    )
+
+# --- Helper: Settings (optional sections in st.secrets) ---
+def get_setting(section, key, default):
+    return st.secrets.get(section, {}).get(key, default)
+
+# --- Helper: Shared Read Cache ---
+# One cache per server process, shared by every session. Entries are tagged with the
+# tables they read; writes bump those tables' generation and drop the tagged entries.
+# A read that started before a write committed never stores its (possibly stale) result.
+class QueryCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires_at, tables, value)
+        self.generations = {}         # table -> write generation
+        self.written_at = {}          # table -> monotonic time of the last write
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, tables):
+        with self.lock:
+            return tuple(self.generations.get(t, 0) for t in tables)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, tables, generation, value, ttl=None):
+        with self.lock:
+            if tuple(self.generations.get(t, 0) for t in tables) != generation:
+                return
+            expires_at = time.monotonic() + (ttl if ttl is not None else self.ttl)
+            self.entries[key] = (expires_at, frozenset(tables), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, tables):
+        tables = set(tables)
+        with self.lock:
+            now = time.monotonic()
+            for t in tables:
+                self.generations[t] = self.generations.get(t, 0) + 1
+                self.written_at[t] = now
+            stale = [k for k, entry in self.entries.items() if entry[1] & tables]
+            for k in stale:
+                del self.entries[k]
+
+    def written_within(self, tables, seconds):
+        # tables=None asks about any table
+        cutoff = time.monotonic() - seconds
+        with self.lock:
+            times = self.written_at.values() if tables is None else [self.written_at.get(t, 0) for t in tables]
+            return any(t and t > cutoff for t in times)
+
+@st.cache_resource
+def get_query_cache():
+    return QueryCache(
+        ttl=float(get_setting("cache", "ttl_seconds", 300)),
+        max_entries=int(get_setting("cache", "max_entries", 512)),
+    )
+
+query_cache = get_query_cache()
+
+# --- Helper: Typed Loading ---
+# Results are stored once per process in the read cache and handed to every session,
+# so their dtypes decide the app's memory footprint. Known columns get a fixed dtype;
+# other integers are downcast, NUMERIC (Decimal objects) becomes float64, DATE columns
+# become Arrow date32 and, with [cache] arrow_strings, remaining text becomes
+# Arrow-backed strings (already the default from pandas 3 on).
+COLUMN_DTYPES = {
+    # Low-cardinality text
+    "category": "category",
+    "country": "category",
+    "city": "category",
+    "status": "category",
+    "payment_method": "category",
+    # SERIAL / INT columns always fit in 32 bits
+    "product_id": "int32",
+    "customer_id": "int32",
+    "order_id": "int32",
+    "order_item_id": "int32",
+    "payment_id": "int32",
+    "stock_quantity": "int32",
+    "quantity": "int32",
+}
+
+if int(pd.__version__.split(".")[0]) < 3:
+    # Default from pandas 3 on: derived frames never write through to a shared one
+    pd.set_option("mode.copy_on_write", True)
+
+def compact(df):
+    arrow_strings = bool(get_setting("cache", "arrow_strings", False))
+    for col in df.columns:
+        series = df[col]
+        dtype = COLUMN_DTYPES.get(col)
+        if dtype == "category":
+            df[col] = series.astype("category")
+        elif dtype and pd.api.types.is_integer_dtype(series.dtype):
+            df[col] = series.astype(dtype)  # columns with NULLs arrive as float and are left alone
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            df[col] = pd.to_numeric(series, downcast="integer")
+        elif series.dtype == object:
+            sample = series.dropna()
+            sample = sample.iloc[0] if len(sample) else None
+            if isinstance(sample, decimal.Decimal):
+                df[col] = pd.to_numeric(series, errors="coerce").astype("float64")
+            elif isinstance(sample, datetime.date) and not isinstance(sample, datetime.datetime):
+                df[col] = series.astype(pd.ArrowDtype(pa.date32()))
+            elif isinstance(sample, str) and arrow_strings:
+                df[col] = series.astype("string[pyarrow]")
+    return df
+
+def read_typed(query, conn, params=None):
+    # Returns the compacted frame and its size in bytes before and after compaction
+    df = pd.read_sql(text(query), conn, params=params)
+    raw_bytes = int(df.memory_usage(deep=True).sum())
+    df = compact(df)
+    return df, raw_bytes, int(df.memory_usage(deep=True).sum())
+
+# --- Helper: Read Routing ---
+# Reads go to the replica unless a table they touch was written through this app in
+# the last few seconds; those go to the primary so the writer (and the shared cache,
+# which would otherwise be refilled from a lagging replica) sees its own writes.
+# Writes (INSERT/UPDATE/CALL, rollup refreshes, imports) always use `engine`.
+def reader_for(tables=None):
+    if read_engine is engine:
+        return engine
+    window = float(get_setting("database", "read_your_writes_seconds", 10))
+    return engine if query_cache.written_within(tables, window) else read_engine
+
+def cached_read(query, tables, params=None, ttl=None):
+    # Returned DataFrames are shared between sessions: never modify them in place.
+    params = params or {}
+    key = (query, repr(sorted(params.items())))
+    df = query_cache.get(key)
+    if df is None:
+        generation = query_cache.generation(tables)
+        with reader_for(tables).connect() as conn:
+            df, raw_bytes, typed_bytes = read_typed(query, conn, params)
+        query_log.annotate_last(raw_frame_bytes=raw_bytes, frame_bytes=typed_bytes)
+        query_cache.put(key, tables, generation, df, ttl)
+    else:
+        query_log.record("cache hit", query, 0.0, len(df))
+    return df
+
+def invalidate(*tables):
+    query_cache.invalidate(tables)
 
-# --- Helper: Download Function ---
-def convert_df_to_excel(df):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Sheet1')
-    output.seek(0)
-    return output
+# --- Helper: Session Memo ---
+# On-demand sections keep their results in the session until a write bumps the
+# generation of a table they read. Reruns of an open section (e.g. a form interaction)
+# then cost no query, even after the shared cache entry has expired or been evicted.
+# A [cache] ttl_seconds of 0 turns this off along with the shared cache. Only call from the script thread: it uses st.session_state.
+def memo_lookup(query, tables, params=None):
+    key = (query, repr(sorted((params or {}).items())))
+    hit = st.session_state.setdefault("section_memo", {}).get(key)
+    if query_cache.ttl > 0 and hit is not None and hit[0] == query_cache.generation(tables):
+        query_log.record("memo hit", query, 0.0, len(hit[1]))
+        return key, hit[1]
+    return key, None
+
+def memo_read(query, tables, params=None):
+    key, df = memo_lookup(query, tables, params)
+    if df is None:
+        generation = query_cache.generation(tables)
+        df = cached_read(query, tables, params)
+        st.session_state["section_memo"][key] = (generation, df)
+    return df
+
+# --- Helper: Concurrent Reads ---
+# Independent reads of one page are dispatched together so the page waits for the
+# slowest query instead of the sum of all round trips. Workers only touch the cache
+# and the engine's connection pool, never Streamlit elements.
+@st.cache_resource
+def get_query_executor():
+    return ThreadPoolExecutor(
+        max_workers=int(get_setting("database", "query_workers", 4)),
+        thread_name_prefix="query",
+    )
+
+def run_queries_concurrently(queries, sections=None, memoize=False, reader=None):
+    # queries: name -> (sql, tables); sections: name -> sub-section for instrumentation.
+    # With memoize, results come from / go to the session memo (see memo_read).
+    # reader defaults to cached_read; it is called as reader(sql, tables).
+    # Returns name -> DataFrame, or the exception raised.
+    executor = get_query_executor()
+    parent = current_section.get()
+    results, futures = {}, {}
+    for name, (query, tables) in queries.items():
+        path = f"{parent}/{sections[name]}" if sections else parent
+        if memoize:
+            key, df = run_in_section(path, memo_lookup, query, tables)
+            if df is not None:
+                results[name] = df
+                continue
+        futures[name] = (
+            key if memoize else None,
+            query_cache.generation(tables),
+            executor.submit(run_in_section, path, reader or cached_read, query, tables),
+        )
+    for name, (key, generation, future) in futures.items():
+        try:
+            results[name] = future.result()
+            if memoize:
+                st.session_state["section_memo"][key] = (generation, results[name])
+        except Exception as e:
+            results[name] = e
+    return results
+
+# --- Helper: Query Instrumentation ---
+# Every statement executed through the engine is timed by cursor events and tagged with
+# the page/section that issued it (e.g. "Admin Panel/Dashboard/Payment Insights").
+# Recent timings feed the hidden Diagnostics page (open the app with ?diagnostics=1).
+@st.cache_resource
+def get_section_var():
+    # Shared across reruns: every rerun re-executes this script, but cached objects
+    # (like the query log) must keep reading the same variable.
+    return contextvars.ContextVar("current_section", default="(app)")
+
+current_section = get_section_var()
+query_logger = logging.getLogger("amazonmart.queries")
+
+@contextlib.contextmanager
+def query_section(name):
+    token = current_section.set(f"{current_section.get()}/{name}")
+    try:
+        yield
+    finally:
+        current_section.reset(token)
+
+def run_in_section(path, fn, *args, **kwargs):
+    # Threads don't inherit the caller's section, so work handed to them carries it along
+    token = current_section.set(path)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        current_section.reset(token)
+
+def normalize_statement(statement):
+    return re.sub(r"\s+", " ", statement).strip()[:200]
+
+class QueryLog:
+    def __init__(self, max_records, slow_ms, explain_slow, explain_timeout_ms, executor):
+        self.records = deque(maxlen=max_records)
+        self.slow = deque(maxlen=100)
+        self.slow_ms = slow_ms
+        self.explain_slow = explain_slow
+        self.explain_timeout_ms = explain_timeout_ms
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def record(self, kind, statement, seconds, rows=None, parameters=None, error=None, database=None):
+        entry = {
+            "at": datetime.datetime.now(),
+            "section": current_section.get(),
+            "kind": kind,
+            "database": database,
+            "statement": normalize_statement(statement),
+            "seconds": seconds,
+            "rows": rows if rows is not None and rows >= 0 else None,
+            # In-memory size of a DataFrame loaded by cached_read, before and after
+            # compaction; bytes on the wire are not exposed by the driver
+            "raw_frame_bytes": None,
+            "frame_bytes": None,
+            "error": error,
+        }
+        with self.lock:
+            self.records.append(entry)
+        self.local.last = entry
+        if kind != "cache hit" and seconds * 1000 >= self.slow_ms and not getattr(self.local, "explaining", False):
+            slow_entry = dict(entry, full_statement=statement, parameters=repr(parameters)[:500], plan=None)
+            with self.lock:
+                self.slow.append(slow_entry)
+            query_logger.warning("Slow query (%.0f ms) in %s: %s", seconds * 1000, entry["section"], entry["statement"])
+            if self.explain_slow and explainable(statement):
+                self.executor.submit(self.explain, slow_entry, statement, parameters, database)
+        return entry
+
+    def annotate_last(self, **fields):
+        entry = getattr(self.local, "last", None)
+        if entry is not None:
+            entry.update(fields)
+
+    def explain(self, slow_entry, statement, parameters, database):
+        # Re-runs the statement under EXPLAIN ANALYZE on its own connection, on the same
+        # server, in a read-only transaction with a time limit
+        self.local.explaining = True
+        try:
+            with (read_engine if database == "replica" else engine).connect() as conn, conn.begin():
+                conn.exec_driver_sql("SET TRANSACTION READ ONLY")
+                conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(self.explain_timeout_ms)}")
+                plan = conn.exec_driver_sql("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters or {})
+                slow_entry["plan"] = "\n".join(row[0] for row in plan)
+        except Exception as e:
+            slow_entry["plan"] = f"EXPLAIN failed: {e}"
+        finally:
+            self.local.explaining = False
+
+    def snapshot(self):
+        with self.lock:
+            return pd.DataFrame(list(self.records)), list(self.slow)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.slow.clear()
+
+def statement_kind(statement):
+    return "read" if statement.lstrip().split(None, 1)[0].upper() in ("SELECT", "WITH", "SHOW", "EXPLAIN") else "write"
+
+# Reads that lock rows, or that are really a function call (SELECT add_leaderboard_drift(...),
+# SELECT pg_advisory_xact_lock(...)), must not run a second time under EXPLAIN ANALYZE
+LOCKING_CLAUSE = re.compile(r"\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b", re.I)
+FUNCTION_CALL = re.compile(r"^\s*SELECT\s+[\w.]+\s*\(", re.I)
+SIDE_EFFECT_FUNCTIONS = re.compile(r"\b(pg_advisory\w*|nextval|setval|pg_notify|pg_sleep|rebuild_\w+)\s*\(", re.I)
+
+def explainable(statement):
+    return (
+        statement_kind(statement) == "read"
+        and not statement.lstrip().upper().startswith("EXPLAIN")
+        and not LOCKING_CLAUSE.search(statement)
+        and not (FUNCTION_CALL.search(statement) and not re.search(r"\bFROM\b", statement, re.I))
+        and not SIDE_EFFECT_FUNCTIONS.search(statement)
+    )
+
+@st.cache_resource
+def get_query_log():
+    log = QueryLog(
+        max_records=int(get_setting("diagnostics", "max_records", 5000)),
+        slow_ms=float(get_setting("diagnostics", "slow_query_ms", 500)),
+        explain_slow=bool(get_setting("diagnostics", "explain_slow_queries", False)),
+        explain_timeout_ms=float(get_setting("diagnostics", "explain_timeout_ms", 10_000)),
+        executor=get_query_executor(),
+    )
+
+    def instrument(target, database):
+        @event.listens_for(target, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+        @event.listens_for(target, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            seconds = time.perf_counter() - conn.info["query_start"].pop()
+            log.record(statement_kind(statement), statement, seconds, cursor.rowcount, parameters,
+                       database=database)
+
+        @event.listens_for(target, "handle_error")
+        def handle_error(context):
+            starts = context.connection.info.get("query_start") if context.connection is not None else None
+            if starts:
+                seconds = time.perf_counter() - starts.pop()
+                log.record(statement_kind(context.statement or "?"), context.statement or "?", seconds,
+                           error=str(context.original_exception).strip().splitlines()[0], database=database)
+
+    instrument(engine, "primary")
+    if read_engine is not engine:
+        instrument(read_engine, "replica")
+    return log
+
+query_log = get_query_log()
+
+# --- Helper: Table Columns (whitelist for projections) ---
+@st.cache_data(ttl=600)
+def get_table_columns(table):
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = :table
+                ORDER BY ordinal_position
+            """),
+            {"table": table}
+        ).fetchall()
+    return [row[0] for row in rows]
+
+def escape_like(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# --- Helper: Product Search (runs in Postgres, keyset-paginated) ---
+PAGE_SIZES = [25, 50, 100, 250]
+
+def product_search_query(columns, term="", match="Contains", after_id=None, limit=None):
+    # ILIKE '%term%' is served by the trigram index, lower(name) LIKE 'term%' by the
+    # text_pattern_ops index; product_id is always fetched because it is the page key.
+    select_cols = ["product_id"] + [c for c in columns if c != "product_id"]
+    clauses, params = [], {}
+    if term:
+        if match == "Starts with":
+            clauses.append("lower(name) LIKE :pattern")
+            params["pattern"] = escape_like(term.lower()) + "%"
+        else:
+            clauses.append("name ILIKE :pattern")
+            params["pattern"] = "%" + escape_like(term) + "%"
+    if after_id is not None:
+        clauses.append("product_id > :after_id")
+        params["after_id"] = int(after_id)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    query = f"""
+        SELECT {', '.join(select_cols)}
+        FROM products
+        {where}
+        ORDER BY product_id
+    """
+    if limit is not None:
+        query += "LIMIT :limit"
+        params["limit"] = limit
+    return query, params
+
+def search_products(columns, term="", match="Contains", after_id=None, limit=50):
+    query, params = product_search_query(columns, term, match, after_id, limit + 1)
+    df = cached_read(query, tables=("products",), params=params)
+    has_next = len(df) > limit
+    return df.head(limit), has_next
+
+# --- Helper: Typeahead Lookups (customers / products) ---
+TYPEAHEAD_LIMIT = 20
+
+def typeahead(table, id_col, term, limit=TYPEAHEAD_LIMIT):
+    # A numeric term is an exact id lookup; anything else is a name prefix read in
+    # index order (~<~ is the text_pattern_ops ordering), so only `limit` entries are touched.
+    term = term.strip()
+    if term.isdigit():
+        query = f"SELECT {id_col} AS id, name FROM {table} WHERE {id_col} = :id"
+        params = {"id": int(term)}
+    else:
+        query = f"""
+            SELECT {id_col} AS id, name
+            FROM {table}
+            WHERE lower(name) LIKE :prefix
+            ORDER BY lower(name) USING ~<~
+            LIMIT :limit
+        """
+        params = {"prefix": escape_like(term.lower()) + "%", "limit": limit}
+    return cached_read(query, tables=(table,), params=params)
+
+def remember_labels(kind, matches):
+    # Session-side label -> id index, so selections survive reruns without new lookups
+    index = st.session_state.setdefault(f"{kind}_label_ids", {})
+    labels = []
+    for row in matches.itertuples(index=False):
+        label = f"{row.name} (ID: {row.id})"
+        index[label] = int(row.id)
+        labels.append(label)
+    return labels
+
+# --- Helper: Order History (order_lines read model) ---
+# Pages are keyset cursors on (order_date, order_id, order_item_id), newest first; the
+# line id makes the key unique, since every line of an order shares the first two.
+# Results are tagged with the read model's source tables, whose writes change it.
+HISTORY_TABLES = ("orders", "order_items", "customers", "products")
+HISTORY_COLUMNS = "order_id, customer, order_date, product, quantity, unit_price, quantity * unit_price AS total_amount, status"
+
+def order_history_query(filters, after=None, limit=None, columns=HISTORY_COLUMNS):
+    # filters: customer_id, product_id, date_from, date_to (inclusive), statuses
+    conditions, params = [], {}
+    if filters.get("customer_id") is not None:
+        conditions.append("customer_id = :customer_id")
+        params["customer_id"] = filters["customer_id"]
+    if filters.get("product_id") is not None:
+        conditions.append("product_id = :product_id")
+        params["product_id"] = filters["product_id"]
+    if filters.get("date_from"):
+        conditions.append("order_date >= :date_from")
+        params["date_from"] = filters["date_from"]
+    if filters.get("date_to"):
+        conditions.append("order_date < :date_to")
+        params["date_to"] = filters["date_to"] + datetime.timedelta(days=1)
+    if filters.get("statuses"):
+        conditions.append("status = ANY(:statuses)")
+        params["statuses"] = list(filters["statuses"])
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+    if after is not None:
+        keyset = "(order_date, order_id, order_item_id) < (:after_date, :after_order, :after_item)"
+        where = f"{where} AND {keyset}" if where else f"WHERE {keyset}"
+        params.update(after_date=after[0], after_order=after[1], after_item=after[2])
+    query = f"""
+        SELECT {columns}
+        FROM order_lines
+        {where}
+        ORDER BY order_date DESC, order_id DESC, order_item_id DESC
+    """
+    if limit is not None:
+        query += "LIMIT :limit"
+        params["limit"] = limit
+    return query, params
+
+def search_order_history(filters, after=None, limit=50):
+    # One extra row tells whether a next page exists
+    query, params = order_history_query(filters, after, limit + 1, columns=HISTORY_COLUMNS + ", order_item_id")
+    df = cached_read(query, tables=HISTORY_TABLES, params=params)
+    return df.head(limit), len(df) > limit
+
+def estimate_rows(query, params=None, tables=()):
+    # The planner's row estimate: instant at any size, unlike COUNT(*)
+    plan = cached_read("EXPLAIN (FORMAT JSON) " + query, tables=tables, params=params)
+    return int(plan.iloc[0, 0][0]["Plan"]["Plan Rows"])
+
+def order_statuses():
+    # Loose index scan over idx_order_lines_status: one probe per distinct status
+    return cached_read("""
+        WITH RECURSIVE s AS (
+            SELECT MIN(status) AS status FROM order_lines
+            UNION ALL
+            SELECT (SELECT MIN(status) FROM order_lines WHERE status > s.status) FROM s WHERE s.status IS NOT NULL
+        )
+        SELECT status FROM s WHERE status IS NOT NULL
+    """, tables=("orders",))["status"].tolist()
+
+# --- Helper: Bulk Order Ingestion ---
+# Uploaded order lines are grouped into orders and submitted in batches: one
+# transaction per batch, one savepoint per order, so a failing order (e.g. a stock
+# violation) is rolled back and reported without aborting the rest of its batch.
+ORDER_LINE_COLUMNS = ["customer_id", "product_id", "quantity"]
+RETRYABLE_SQLSTATES = {"40001", "40P01"}  # serialization_failure, deadlock_detected
+
+def is_retryable(e):
+    return getattr(getattr(e, "orig", None), "pgcode", None) in RETRYABLE_SQLSTATES
+
+def error_message(e):
+    return str(getattr(e, "orig", e)).strip().splitlines()[0]
+
+def read_order_lines(uploaded):
+    # Rows are indexed by their line in the file (a CSV's first line is its header)
+    if uploaded.name.lower().endswith(".parquet"):
+        df = pd.read_parquet(uploaded)
+        df.index = range(1, len(df) + 1)
+    else:
+        df = pd.read_csv(uploaded)
+        df.index = range(2, len(df) + 2)
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    missing = set(ORDER_LINE_COLUMNS) - set(df.columns)
+    if missing:
+        raise ValueError(f"missing column(s): {', '.join(sorted(missing))}")
+    return df
+
+def group_order_lines(df):
+    # One order per order_ref if the file has that column, otherwise one per run of
+    # consecutive lines for the same customer. Orders are formed before validation, so
+    # an order with an invalid line is rejected whole rather than placed without it.
+    # Returns (orders, failures).
+    if "order_ref" in df.columns:
+        keys = df["order_ref"].astype(str)
+    else:
+        keys = (df["customer_id"] != df["customer_id"].shift()).cumsum()
+    for col in ORDER_LINE_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors="coerce")
+    # Ids and quantities must be positive whole numbers; int() below would otherwise
+    # truncate 2.9 to 2 and place the order for the wrong product or quantity
+    values = df[ORDER_LINE_COLUMNS]
+    invalid = values.isna().any(axis=1) | (values <= 0).any(axis=1) | (values % 1 != 0).any(axis=1)
+
+    orders, failures = [], []
+    for key, lines in df.groupby(keys, sort=False):
+        ref = str(key) if "order_ref" in df.columns else f"line {lines.index[0]}"
+        bad_lines = lines.index[invalid[lines.index]]
+        if len(bad_lines):
+            failures.append({
+                "order": ref, "customer_id": None,
+                "error": "invalid customer_id, product_id or quantity on line "
+                         + ", ".join(str(i) for i in bad_lines),
+            })
+            continue
+        if lines["customer_id"].nunique() > 1:
+            failures.append({"order": ref, "customer_id": None, "error": "order lines belong to different customers"})
+            continue
+        # Duplicate products are merged and ids sorted so orders lock rows in one order
+        qtys = lines.groupby("product_id")["quantity"].sum()
+        orders.append({
+            "ref": ref,
+            "customer_id": int(lines["customer_id"].iloc[0]),
+            "product_ids": [int(pid) for pid in qtys.index],
+            "qtys": [int(q) for q in qtys.values],
+            "lines": len(lines),
+        })
+    return orders, failures
+
+def submit_order_batch(orders, retries=3):
+    # The batch locks the leaderboard rows of its customers and then every product it
+    # touches up front, each in id order. That is the order a single placement takes
+    # them in (its orders row bumps customer_totals before it locks products), so
+    # batches and single orders queue on shared rows instead of deadlocking on them.
+    failures = []
+    customer_ids = sorted({order["customer_id"] for order in orders})
+    product_ids = sorted({pid for order in orders for pid in order["product_ids"]})
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO customer_totals (customer_id)
+                    SELECT customer_id FROM customers WHERE customer_id = ANY(:ids) ORDER BY customer_id
+                    ON CONFLICT (customer_id) DO NOTHING
+                """),
+                {"ids": customer_ids}
+            )
+            conn.execute(
+                text("SELECT customer_id FROM customer_totals WHERE customer_id = ANY(:ids) ORDER BY customer_id FOR UPDATE"),
+                {"ids": customer_ids}
+            )
+            conn.execute(
+                text("SELECT product_id FROM products WHERE product_id = ANY(:ids) ORDER BY product_id FOR UPDATE"),
+                {"ids": product_ids}
+            )
+            for order in orders:
+                for attempt in range(retries + 1):
+                    try:
+                        with conn.begin_nested():
+                            conn.execute(
+                                text("CALL PlaceMultiProductOrder(:customer_id, :product_ids, :qtys)"),
+                                {"customer_id": order["customer_id"], "product_ids": order["product_ids"],
+                                 "qtys": order["qtys"]}
+                            )
+                        break
+                    except Exception as e:
+                        if is_retryable(e) and attempt < retries:
+                            time.sleep(0.05 * 2 ** attempt)
+                            continue
+                        failures.append({"order": order["ref"], "customer_id": order["customer_id"],
+                                         "error": error_message(e)})
+                        break
+    except Exception as e:
+        failed = {f["order"] for f in failures}
+        failures += [
+            {"order": o["ref"], "customer_id": o["customer_id"], "error": f"batch aborted: {error_message(e)}"}
+            for o in orders if o["ref"] not in failed
+        ]
+    return failures
+
+# --- Helper: Order Submission Queue ---
+# Place Order writes behind a bounded queue. A click only records the submission under
+# the session's idempotency key (a repeated click finds the existing row) and a fixed
+# pool of workers places it, which also caps concurrent calls into the procedure. A
+# worker claims the row, calls the procedure and marks the row placed in one
+# transaction, so an order is placed at most once. A sweeper re-enqueues rows left
+# queued by a restart or by another server process that died; whichever worker claims
+# such a row first places it, and any other finds it settled or locked and skips it.
+class OrderQueue:
+    def __init__(self, workers, max_queued, retries, sweep_seconds):
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.waiting = set()  # keys in this process's queue
+        self.in_flight = set()
+        self.latencies = deque(maxlen=1000)  # seconds from submission to outcome
+        self.counts = {"submitted": 0, "duplicates": 0, "rejected": 0, "placed": 0, "failed": 0, "retries": 0}
+        for n in range(workers):
+            threading.Thread(target=self.run, name=f"order-worker-{n}", daemon=True).start()
+        threading.Thread(target=self.sweep, args=(sweep_seconds,), name="order-sweeper", daemon=True).start()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def enqueue(self, key):
+        with self.lock:
+            if key in self.waiting or key in self.in_flight:
+                return
+            self.queue.put_nowait((key, time.monotonic()))
+            self.waiting.add(key)
+
+    def sweep(self, interval):
+        # Everything still queued at start; later only rows older than one interval,
+        # which a live process would normally have placed by then
+        min_age = 0
+        while True:
+            try:
+                with engine.connect() as conn:
+                    keys = conn.execute(
+                        text("""
+                            SELECT idempotency_key FROM order_submissions
+                            WHERE status = 'queued' AND submitted_at <= now() - make_interval(secs => :min_age)
+                            ORDER BY submitted_at
+                            LIMIT :room
+                        """),
+                        {"min_age": min_age, "room": max(self.queue.maxsize - self.queue.qsize(), 0)}
+                    ).scalars().all()
+                for key in keys:
+                    self.enqueue(key)
+            except queue.Full:
+                pass  # the rest waits for the next sweep
+            except Exception as e:
+                query_logger.warning("Could not requeue pending orders: %s", e)
+            min_age = interval
+            time.sleep(interval)
+
+    def submit(self, key, customer_id, product_ids, quantities):
+        # Lines go in product id order so concurrent orders lock shared products alike
+        lines = sorted(zip(product_ids, quantities))
+        with engine.begin() as conn:
+            inserted = conn.execute(
+                text("""
+                    INSERT INTO order_submissions (idempotency_key, customer_id, product_ids, quantities)
+                    VALUES (:key, :customer_id, :product_ids, :qtys)
+                    ON CONFLICT (idempotency_key) DO NOTHING
+                    RETURNING idempotency_key
+                """),
+                {"key": key, "customer_id": customer_id,
+                 "product_ids": [p for p, _ in lines], "qtys": [int(q) for _, q in lines]}
+            ).first()
+        if inserted is None:
+            self.count("duplicates")
+            return
+        try:
+            self.enqueue(key)
+            self.count("submitted")
+        except queue.Full:
+            self.count("rejected")
+            self.finish(key, "failed", 0, "The order queue is full, please try again in a moment")
+
+    def finish(self, key, status, attempts, error=None):
+        with engine.begin() as conn:
+            conn.execute(
+                text("""
+                    UPDATE order_submissions
+                    SET status = :status, attempts = :attempts, error = :error, finished_at = now()
+                    WHERE idempotency_key = :key AND status = 'queued'
+                """),
+                {"key": key, "status": status, "attempts": attempts, "error": error}
+            )
+
+    def run(self):
+        while True:
+            key, queued_at = self.queue.get()
+            with self.lock:
+                self.waiting.discard(key)
+                self.in_flight.add(key)
+            try:
+                run_in_section("Place Order/Queue", self.place, key)
+            except Exception as e:
+                query_logger.warning("Order submission %s could not be processed: %s", key, e)
+            finally:
+                with self.lock:
+                    self.in_flight.discard(key)
+                    self.latencies.append(time.monotonic() - queued_at)
+
+    def place(self, key):
+        for attempt in range(self.retries + 1):
+            try:
+                with engine.begin() as conn:
+                    row = conn.execute(
+                        text("""
+                            SELECT customer_id, product_ids, quantities FROM order_submissions
+                            WHERE idempotency_key = :key AND status = 'queued'
+                            FOR UPDATE SKIP LOCKED
+                        """),
+                        {"key": key}
+                    ).first()
+                    if row is None:
+                        return  # already settled, or another worker holds it
+                    conn.execute(
+                        text("CALL PlaceMultiProductOrder(:customer_id, :product_ids, :qtys)"),
+                        {"customer_id": row.customer_id, "product_ids": row.product_ids, "qtys": row.quantities}
+                    )
+                    conn.execute(
+                        text("""
+                            UPDATE order_submissions
+                            SET status = 'placed', attempts = :attempts, finished_at = now(),
+                                order_id = currval(pg_get_serial_sequence('orders', 'order_id'))
+                            WHERE idempotency_key = :key
+                        """),
+                        {"key": key, "attempts": attempt + 1}
+                    )
+                invalidate("orders", "order_items", "payments", "products")
+                self.count("placed")
+                return
+            except Exception as e:
+                if is_retryable(e) and attempt < self.retries:
+                    self.count("retries")
+                    time.sleep(0.05 * 2 ** attempt)
+                    continue
+                self.finish(key, "failed", attempt + 1, error_message(e))
+                self.count("failed")
+                return
+
+    def status(self, key):
+        with engine.connect() as conn:
+            row = conn.execute(
+                text("SELECT status, order_id, error FROM order_submissions WHERE idempotency_key = :key"),
+                {"key": key}
+            ).first()
+        if row is None:
+            return {"status": "unknown", "order_id": None, "error": None}
+        status = row.status
+        with self.lock:
+            if status == "queued" and key in self.in_flight:
+                status = "processing"
+        return {"status": status, "order_id": row.order_id, "error": row.error}
+
+    def metrics(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return dict(
+                self.counts,
+                queued=self.queue.qsize(),
+                in_flight=len(self.in_flight),
+                p50_ms=latencies[len(latencies) // 2] * 1000 if latencies else None,
+                p95_ms=latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+            )
+
+@st.cache_resource
+def get_order_queue():
+    return OrderQueue(
+        workers=int(get_setting("orders", "workers", 4)),
+        max_queued=int(get_setting("orders", "queue_size", 200)),
+        retries=int(get_setting("orders", "max_retries", 3)),
+        sweep_seconds=float(get_setting("orders", "sweep_seconds", 30)),
+    )
+
+# Started with the app rather than on the first order, so the sweeper runs regardless
+order_queue = get_order_queue()
+
+# --- Helper: Bulk Import (COPY) ---
+# Files are streamed with COPY FROM STDIN into an all-text staging table, validated
+# there in SQL, and merged in the same transaction. Products match on name (like the
+# Existing Product form: new price, stock added); customers match on email.
+IMPORT_SPECS = {
+    "products": {
+        "required": ["name", "category", "price", "stock_quantity"],
+        "optional": [],
+        "writes": ("products",),
+        "reason": r"""
+            CASE
+                WHEN NULLIF(trim(name), '') IS NULL THEN 'missing name'
+                WHEN NULLIF(trim(category), '') IS NULL THEN 'missing category'
+                WHEN COALESCE(price, '') !~ '^\s*[0-9]+(\.[0-9]+)?\s*$'
+                     OR NOT import_value_ok(price, 'numeric(10,2)') THEN 'invalid price'
+                WHEN COALESCE(stock_quantity, '') !~ '^\s*[0-9]+\s*$'
+                     OR NOT import_value_ok(stock_quantity, 'int') THEN 'invalid stock_quantity'
+            END
+        """,
+        "merge": [
+            (None, """
+                CREATE TEMP TABLE import_merged ON COMMIT DROP AS
+                SELECT trim(name) AS name,
+                       (array_agg(trim(category) ORDER BY line DESC))[1] AS category,
+                       (array_agg(price::numeric ORDER BY line DESC))[1] AS price,
+                       SUM(stock_quantity::int) AS stock_quantity
+                FROM import_rows
+                WHERE reason IS NULL
+                GROUP BY trim(name)
+            """),
+            (None, "LOCK TABLE products IN SHARE ROW EXCLUSIVE MODE"),
+            ("updated", """
+                UPDATE products p
+                SET price = m.price,
+                    stock_quantity = p.stock_quantity + m.stock_quantity
+                FROM import_merged m
+                WHERE p.name = m.name
+            """),
+            ("inserted", """
+                INSERT INTO products (name, category, price, stock_quantity)
+                SELECT name, category, price, stock_quantity
+                FROM import_merged m
+                WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.name = m.name)
+            """),
+        ],
+    },
+    "customers": {
+        "required": ["name", "email", "city", "country"],
+        "optional": ["registration_date"],
+        # Updated city/country move already-folded customers between rollup buckets
+        "writes": ("customers", "rollup_customers_daily"),
+        "reason": r"""
+            CASE
+                WHEN NULLIF(trim(name), '') IS NULL THEN 'missing name'
+                WHEN COALESCE(email, '') !~ '^\s*[^@\s]+@[^@\s]+\s*$' THEN 'invalid email'
+                WHEN NULLIF(trim(city), '') IS NULL THEN 'missing city'
+                WHEN NULLIF(trim(country), '') IS NULL THEN 'missing country'
+                WHEN NULLIF(trim(registration_date), '') IS NOT NULL
+                     AND (registration_date !~ '^\s*[0-9]{4}-[0-9]{2}-[0-9]{2}\s*$'
+                          OR NOT import_value_ok(trim(registration_date), 'date')) THEN 'invalid registration_date'
+            END
+        """,
+        "merge": [
+            (None, """
+                CREATE TEMP TABLE import_merged ON COMMIT DROP AS
+                SELECT DISTINCT ON (lower(trim(email)))
+                       trim(name) AS name,
+                       trim(email) AS email,
+                       lower(trim(email)) AS email_key,
+                       trim(city) AS city,
+                       trim(country) AS country,
+                       NULLIF(trim(registration_date), '')::date AS registration_date
+                FROM import_rows
+                WHERE reason IS NULL
+                ORDER BY lower(trim(email)), line DESC
+            """),
+            (None, "LOCK TABLE customers IN SHARE ROW EXCLUSIVE MODE"),
+            ("updated", """
+                UPDATE customers c
+                SET name = m.name, city = m.city, country = m.country
+                FROM import_merged m
+                WHERE lower(c.email) = m.email_key
+            """),
+            ("inserted", """
+                INSERT INTO customers (name, email, city, country, registration_date)
+                SELECT name, email, city, country, COALESCE(registration_date, CURRENT_DATE)
+                FROM import_merged m
+                WHERE NOT EXISTS (SELECT 1 FROM customers c WHERE lower(c.email) = m.email_key)
+            """),
+        ],
+    },
+}
+
+class ProgressReader:
+    # File wrapper handed to COPY; reports how many bytes have been consumed
+    def __init__(self, raw, total, callback):
+        self.raw = raw
+        self.total = total
+        self.callback = callback
+        self.done = 0
+
+    def read(self, size=-1):
+        chunk = self.raw.read(size)
+        self.done += len(chunk)
+        if self.callback:
+            self.callback(self.done, self.total)
+        return chunk
+
+    def readline(self, size=-1):
+        line = self.raw.readline(size)
+        self.done += len(line)
+        return line
+
+def bulk_import(kind, uploaded, on_progress=None):
+    spec = IMPORT_SPECS[kind]
+    allowed = spec["required"] + spec["optional"]
+    header = next(csv.reader([uploaded.readline().decode("utf-8-sig")]), [])
+    columns = [c.strip().lower() for c in header]
+    unknown = [c for c in columns if c not in allowed]
+    missing = [c for c in spec["required"] if c not in columns]
+    if unknown or missing:
+        raise ValueError(f"missing column(s): {missing or '-'}; unknown column(s): {unknown or '-'}")
+    total = uploaded.seek(0, io.SEEK_END)
+    uploaded.seek(0)
+
+    stats = {}
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE TEMP TABLE import_rows (
+                line BIGSERIAL,
+                {', '.join(f'{c} TEXT' for c in allowed)},
+                reason TEXT
+            ) ON COMMIT DROP
+        """))
+        start = time.perf_counter()
+        with conn.connection.dbapi_connection.cursor() as cur:
+            cur.copy_expert(
+                f"COPY import_rows ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, HEADER true)",
+                ProgressReader(uploaded, total, on_progress)
+            )
+            stats["rows"] = cur.rowcount
+        stats["copy_seconds"] = time.perf_counter() - start
+        stats["bytes"] = total
+        query_log.record("write", f"COPY import_rows ({', '.join(columns)}) FROM STDIN", stats["copy_seconds"],
+                         stats["rows"], database="primary")
+
+        start = time.perf_counter()
+        conn.execute(text(f"UPDATE import_rows SET reason = {spec['reason']}"))
+        rejected = pd.read_sql(
+            text("SELECT line, reason FROM import_rows WHERE reason IS NOT NULL ORDER BY line"), conn
+        )
+        for label, statement in spec["merge"]:
+            result = conn.execute(text(statement))
+            if label:
+                stats[label] = result.rowcount
+        stats["merge_seconds"] = time.perf_counter() - start
+    invalidate(*spec["writes"])
+    return stats, rejected
+
+def bulk_import_form(kind):
+    spec = IMPORT_SPECS[kind]
+    st.caption(
+        f"CSV with a header row. Required: {', '.join(spec['required'])}"
+        + (f"; optional: {', '.join(spec['optional'])}" if spec["optional"] else "")
+    )
+    uploaded = st.file_uploader(f"{kind.title()} CSV", type=["csv"], key=f"{kind}_import_file")
+    if uploaded is None or not st.button(f"📤 Import {kind.title()}", key=f"{kind}_import"):
+        return
+
+    progress = st.progress(0.0, text="Loading with COPY...")
+    def on_progress(done, total):
+        progress.progress(min(done / max(total, 1), 1.0), text=f"COPY {done / 1e6:,.1f} / {total / 1e6:,.1f} MB")
+
+    try:
+        stats, rejected = bulk_import(kind, uploaded, on_progress)
+    except Exception as e:
+        st.error(f"❌ Error importing {kind}: {error_message(e)}")
+        return
+    progress.progress(1.0, text="Done")
+
+    elapsed = stats["copy_seconds"] + stats["merge_seconds"]
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("Inserted", f"{stats['inserted']:,}")
+    m2.metric("Updated", f"{stats['updated']:,}")
+    m3.metric("Rejected", f"{len(rejected):,}")
+    m4.metric("Rows/sec", f"{stats['rows'] / elapsed:,.0f}" if elapsed > 0 else "-")
+    st.caption(
+        f"{stats['rows']:,} rows · COPY {stats['copy_seconds']:.2f} s "
+        f"({stats['bytes'] / 1e6 / max(stats['copy_seconds'], 1e-9):,.1f} MB/s) · "
+        f"validate + merge {stats['merge_seconds']:.2f} s"
+    )
+    if not rejected.empty:
+        st.dataframe(rejected)
+
+# --- Helper: Commit-safe Watermarks ---
+# Ids are handed out before commit and transactions commit out of order, so MAX(id) is
+# not a safe watermark on its own: a lower id can still commit after it has been read.
+# A candidate (MAX(id), xmax of the snapshot it was read in) becomes safe once every
+# transaction running at that point has finished, i.e. once the current snapshot's
+# xmin has reached that xmax. Until then it is kept as the pending candidate.
+def safe_watermark(conn, table, id_col, pending=None, wait=0.0):
+    # Returns (highest id that is safe to read up to, or None; candidate left pending)
+    fresh = tuple(conn.execute(text(f"""
+        SELECT COALESCE(MAX({id_col}), 0), pg_snapshot_xmax(pg_current_snapshot())::text::bigint FROM {table}
+    """)).one())
+    deadline = time.monotonic() + wait
+    while True:
+        horizon = conn.execute(text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")).scalar()
+        if fresh[1] <= horizon or time.monotonic() >= deadline:
+            break
+        time.sleep(0.1)
+    safe = [c for c in (pending, fresh) if c is not None and c[1] <= horizon]
+    hi = max((c[0] for c in safe), default=None)
+    if fresh in safe:
+        return hi, None
+    # Keep an older pending candidate rather than replacing it, so it can't starve
+    return hi, (pending if pending is not None and pending not in safe else fresh)
+
+# --- Helper: Dashboard Rollups ---
+# Each source table is folded into its rollups by primary-key watermark: a refresh only
+# aggregates rows with last_id < id <= hi and adds them to the existing totals, where
+# hi is a commit-safe watermark (see safe_watermark).
+# Later changes to already-folded rows (e.g. an order's status moving on) are applied
+# by the rollup triggers; rebuild_rollups() recomputes everything from scratch.
+ROLLUP_TABLES = ("rollup_customers_daily", "rollup_orders_daily", "rollup_payments_daily")
+ROLLUP_REBUILD_WAIT_SECONDS = 5.0
+
+ROLLUP_SOURCES = [
+    ("customers", "customer_id", ["""
+        INSERT INTO rollup_customers_daily AS r (day, country, city, new_customers)
+        SELECT registration_date, country, city, COUNT(*)
+        FROM customers
+        WHERE customer_id > :lo AND customer_id <= :hi
+        GROUP BY registration_date, country, city
+        ON CONFLICT (day, country, city)
+        DO UPDATE SET new_customers = r.new_customers + EXCLUDED.new_customers
+    """]),
+    ("orders", "order_id", ["""
+        INSERT INTO rollup_orders_daily AS r (day, status, num_orders)
+        SELECT order_date::date, status, COUNT(*)
+        FROM orders
+        WHERE order_id > :lo AND order_id <= :hi
+        GROUP BY order_date::date, status
+        ON CONFLICT (day, status)
+        DO UPDATE SET num_orders = r.num_orders + EXCLUDED.num_orders
+    """]),
+    ("payments", "payment_id", ["""
+        INSERT INTO rollup_payments_daily AS r (day, payment_method, num_payments, revenue)
+        SELECT payment_date::date, payment_method, COUNT(*), COALESCE(SUM(amount), 0)
+        FROM payments
+        WHERE payment_id > :lo AND payment_id <= :hi
+        GROUP BY payment_date::date, payment_method
+        ON CONFLICT (day, payment_method)
+        DO UPDATE SET num_payments = r.num_payments + EXCLUDED.num_payments,
+                      revenue = r.revenue + EXCLUDED.revenue
+    """]),
+]
+
+def read_rollup_marks(conn):
+    return {
+        row.source: row for row in
+        conn.execute(text("SELECT source, last_id, pending_id, pending_xmax FROM rollup_watermarks"))
+    }
+
+def refresh_rollups(wait=0.0):
+    # The advisory lock serialises concurrent refreshes; watermarks move in the same
+    # transaction as the totals, so a failed refresh folds nothing.
+    folded = {}
+    with engine.begin() as conn:
+        # All watermarks are settled before the lock, which the rollup triggers of
+        # in-flight writers would wait on, and before the first write, which gives this
+        # transaction an xid of its own that would hold the horizon back
+        marks, settled = read_rollup_marks(conn), {}
+        for source, id_col, _ in ROLLUP_SOURCES:
+            mark = marks.get(source)
+            pending = (mark.pending_id, mark.pending_xmax) if mark and mark.pending_id is not None else None
+            settled[source] = (pending, *safe_watermark(conn, source, id_col, pending, wait=wait))
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ROLLUP_LOCK_KEY})
+        # Re-read under the lock: another refresh may have moved them meanwhile
+        marks = read_rollup_marks(conn)
+        plans = []
+        for source, _, statements in ROLLUP_SOURCES:
+            lo = marks[source].last_id if source in marks else 0
+            pending, hi, new_pending = settled[source]
+            plans.append((source, statements, lo, max(hi or 0, lo), pending, new_pending))
+        for source, statements, lo, hi, pending, new_pending in plans:
+            if hi <= lo and new_pending == pending:
+                continue
+            for statement in statements if hi > lo else []:
+                conn.execute(text(statement), {"lo": lo, "hi": hi})
+            conn.execute(
+                text("""
+                    INSERT INTO rollup_watermarks (source, last_id, pending_id, pending_xmax, refreshed_at)
+                    VALUES (:source, :hi, :pending_id, :pending_xmax, now())
+                    ON CONFLICT (source) DO UPDATE
+                    SET last_id = EXCLUDED.last_id, pending_id = EXCLUDED.pending_id,
+                        pending_xmax = EXCLUDED.pending_xmax, refreshed_at = EXCLUDED.refreshed_at
+                """),
+                {"source": source, "hi": hi, "pending_id": new_pending[0] if new_pending else None,
+                 "pending_xmax": new_pending[1] if new_pending else None}
+            )
+            if hi > lo:
+                folded[source] = hi - lo
+    if folded:
+        invalidate(*ROLLUP_TABLES)
+    return folded
+
+def rebuild_rollups():
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ROLLUP_LOCK_KEY})
+        conn.execute(text(f"TRUNCATE {', '.join(ROLLUP_TABLES)}"))
+        conn.execute(
+            text("DELETE FROM rollup_watermarks WHERE source = ANY(:sources)"),
+            {"sources": [source for source, _, _ in ROLLUP_SOURCES]}
+        )
+    invalidate(*ROLLUP_TABLES)
+    # Waits a little for in-flight writers, so the rebuilt rollups aren't left empty
+    return refresh_rollups(wait=ROLLUP_REBUILD_WAIT_SECONDS)
+
+@st.cache_resource
+def get_rollup_state():
+    return {"last_refresh": 0.0, "lock": threading.Lock()}
+
+def maybe_refresh_rollups():
+    # At most one refresh per interval per server process, however many sessions render
+    state = get_rollup_state()
+    interval = float(get_setting("rollups", "refresh_interval_seconds", 60))
+    if time.monotonic() - state["last_refresh"] < interval or not state["lock"].acquire(blocking=False):
+        return None
+    try:
+        folded = refresh_rollups()
+        state["last_refresh"] = time.monotonic()
+        return folded
+    finally:
+        state["lock"].release()
+
+# --- Helper: Leaderboard Check ---
+# Stored totals against the same totals computed from the raw tables, in one snapshot
+# (the leaderboard_drift view). Totals of zero and missing rows count as equal.
+LEADERBOARD_TABLES = ("customer_totals", "product_totals")
+LEADERBOARD_CHECK = "SELECT entity, id, total, stored, expected FROM leaderboard_drift ORDER BY entity, id, total"
+
+def repair_leaderboards(mismatches):
+    with engine.begin() as conn:
+        conn.execute(
+            text("SELECT add_leaderboard_drift(:entities, :ids, :totals, :deltas)"),
+            {"entities": mismatches["entity"].tolist(), "ids": [int(i) for i in mismatches["id"]],
+             "totals": mismatches["total"].tolist(),
+             "deltas": [expected - stored for stored, expected in zip(mismatches["stored"], mismatches["expected"])]}
+        )
+    invalidate(*LEADERBOARD_TABLES)
+
+def verify_leaderboards(repair=False):
+    # Runs on the primary so a repair follows from what was just checked
+    with engine.connect() as conn:
+        mismatches, _, _ = read_typed(LEADERBOARD_CHECK, conn)
+    if repair and not mismatches.empty:
+        repair_leaderboards(mismatches)
+    return mismatches
+
+# --- Helper: Live Order Tracking ---
+# Track Orders keeps the rows it has already fetched in session state and only asks
+# for orders above track_last_id, a commit-safe watermark (see safe_watermark): an
+# order that commits after higher ids have been shown is still above it, however
+# far below them it is.
+TRACKING_QUERY = """
+    SELECT o.order_id, c.name AS customer, o.order_date, p.name AS product,
+           oi.quantity, oi.unit_price, (oi.quantity * oi.unit_price) AS total_amount
+    FROM orders o
+    JOIN customers c ON o.customer_id = c.customer_id
+    JOIN order_items oi ON oi.order_id = o.order_id
+    JOIN products p ON oi.product_id = p.product_id
+    WHERE o.order_date >= CURRENT_DATE - INTERVAL '1 day'
+      AND o.order_id > :after_id
+    ORDER BY o.order_date DESC
+"""
+
+def poll_tracked_orders(max_rows):
+    state = st.session_state
+    last_id = state.get("track_last_id", 0)
+    # The watermark is checked on the connection that reads the rows, so it also holds
+    # on a lagging replica
+    with reader_for(("orders", "order_items", "customers", "products")).connect() as conn:
+        hi, state["track_pending"] = safe_watermark(conn, "orders", "order_id", state.get("track_pending"))
+        new_rows, _, _ = read_typed(TRACKING_QUERY, conn, {"after_id": last_id})
+    rows = state.get("track_rows")
+    if rows is not None:
+        new_rows = new_rows[~new_rows["order_id"].isin(rows["order_id"])]
+        rows = pd.concat([new_rows, rows], ignore_index=True)
+    else:
+        rows = new_rows
+    # Same one-day window as the query, capped to the newest max_rows lines
+    cutoff = pd.Timestamp(datetime.date.today() - datetime.timedelta(days=1))
+    # concat of differing categories falls back to object, so compact again
+    rows = compact(rows[pd.to_datetime(rows["order_date"]) >= cutoff].head(max_rows))
+    state["track_rows"] = rows
+    state["track_last_id"] = max(last_id, hi or 0)
+    return len(new_rows)
+
+class OrderListener:
+    # LISTENs on the channel fed by trg_orders_notify, on its own connection outside
+    # the pool, and remembers the highest order_id announced.
+    def __init__(self, channel="new_orders"):
+        self.channel = channel
+        self.latest_id = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="order-listener", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            conn = None
+            try:
+                cargs, cparams = engine.dialect.create_connect_args(engine.url)
+                conn = engine.dialect.connect(*cargs, **cparams)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel}")
+                self.error = None
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.latest_id = max(self.latest_id, int(notify.payload))
+            except Exception as e:
+                self.error = e
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+@st.cache_resource
+def get_order_listener():
+    return OrderListener()
+
+# --- Dashboard Queries (per expander) ---
+DASHBOARD_QUERIES = {
+    "Customer Insights": {
+        "total_customers": ("""
+            SELECT COALESCE(SUM(new_customers), 0)::bigint AS total_customers FROM rollup_customers_daily
+        """, ("rollup_customers_daily",)),
+        "by_country": ("""
+            SELECT country, SUM(new_customers)::bigint AS num_customers
+            FROM rollup_customers_daily
+            GROUP BY country
+            ORDER BY num_customers DESC
+        """, ("rollup_customers_daily",)),
+        "by_city": ("""
+            SELECT city, country, SUM(new_customers)::bigint AS num_customers
+            FROM rollup_customers_daily
+            GROUP BY city, country
+            ORDER BY num_customers DESC
+            LIMIT 10
+        """, ("rollup_customers_daily",)),
+        # Leaderboards change with their source rows, so those are listed as well
+        "top_spenders": ("""
+            SELECT c.customer_id, c.name, c.email, t.total_spending
+            FROM customer_totals t
+            JOIN customers c ON c.customer_id = t.customer_id
+            WHERE t.total_spending > 0
+            ORDER BY t.total_spending DESC, t.customer_id
+            LIMIT 10
+        """, ("customer_totals", "customers", "orders", "payments")),
+        "monthly_regs": ("""
+            SELECT
+                TO_CHAR(day, 'YYYY-MM') AS registration_month,
+                SUM(new_customers)::bigint AS new_customers
+            FROM rollup_customers_daily
+            GROUP BY registration_month
+            ORDER BY registration_month
+        """, ("rollup_customers_daily",)),
+        "yearly_regs": ("""
+            SELECT
+                EXTRACT(YEAR FROM day) AS registration_year,
+                SUM(new_customers)::bigint AS new_customers
+            FROM rollup_customers_daily
+            GROUP BY registration_year
+            ORDER BY registration_year
+        """, ("rollup_customers_daily",)),
+    },
+    "Orders Analysis": {
+        "order_status": ("""
+            SELECT status, SUM(num_orders)::bigint AS count
+            FROM rollup_orders_daily
+            GROUP BY status
+            ORDER BY count DESC
+        """, ("rollup_orders_daily",)),
+        "orders_by_month": ("""
+            SELECT TO_CHAR(day, 'YYYY-MM') AS order_month, SUM(num_orders)::bigint AS num_orders
+            FROM rollup_orders_daily
+            GROUP BY order_month
+            ORDER BY order_month
+        """, ("rollup_orders_daily",)),
+        "top_customers": ("""
+            SELECT c.customer_id, c.name, t.total_orders
+            FROM customer_totals t
+            JOIN customers c ON c.customer_id = t.customer_id
+            WHERE t.total_orders > 0
+            ORDER BY t.total_orders DESC, t.customer_id
+            LIMIT 10
+        """, ("customer_totals", "customers", "orders")),
+    },
+    "Product Analysis": {
+        "top_products": ("""
+            SELECT p.product_id, p.name, t.total_sold
+            FROM product_totals t
+            JOIN products p ON p.product_id = t.product_id
+            WHERE t.total_sold > 0
+            ORDER BY t.total_sold DESC, t.product_id
+            LIMIT 10
+        """, ("product_totals", "products", "order_items")),
+        "category_sales": ("""
+            SELECT p.category, SUM(t.total_sold)::bigint AS total_quantity
+            FROM product_totals t
+            JOIN products p ON t.product_id = p.product_id
+            GROUP BY p.category
+            ORDER BY total_quantity DESC
+        """, ("product_totals", "products", "order_items")),
+    },
+    "Payment Insights": {
+        "payment_methods": ("""
+            SELECT payment_method, SUM(num_payments)::bigint AS num_payments
+            FROM rollup_payments_daily
+            GROUP BY payment_method
+            ORDER BY num_payments DESC
+        """, ("rollup_payments_daily",)),
+        "monthly_revenue": ("""
+            SELECT TO_CHAR(day, 'YYYY-MM') AS pay_month, SUM(revenue) AS total_revenue
+            FROM rollup_payments_daily
+            GROUP BY pay_month
+            ORDER BY pay_month
+        """, ("rollup_payments_daily",)),
+    },
+}
+
+def show_result(results, name, title, render):
+    if title:
+        st.write(title)
+    result = results[name]
+    if isinstance(result, Exception):
+        st.error(f"❌ Error loading {name}: {result}")
+    else:
+        render(result)
+
+# --- Helper: Streaming Export ---
+# Downloads are generated only when the button is clicked (deferred download data).
+# Rows come through a server-side cursor in chunks and are written straight to a
+# temporary file, so memory stays bounded however many rows the query returns.
+# The file is handed back re-opened with open(): download data must be a plain
+# binary file (BufferedReader), which a TemporaryFile object is not.
+EXPORT_CHUNK_ROWS = 10_000
+EXCEL_MAX_ROWS = 1_048_576  # per sheet, header included
+
+def stream_rows(query, params=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    # Yields the column names first, then lists of up to chunk_rows rows
+    with reader_for().connect() as conn:
+        result = conn.execution_options(yield_per=chunk_rows).execute(text(query), params or {})
+        yield list(result.keys())
+        for partition in result.partitions():
+            yield partition
+
+def open_export(output):
+    # The open handle keeps the data readable once the name is gone (POSIX); where an
+    # open file can't be removed, the temp dir keeps it instead
+    output.close()
+    reader = open(output.name, "rb")
+    try:
+        os.unlink(output.name)
+    except OSError:
+        pass
+    return reader
+
+def export_csv(query, params=None):
+    output = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+    text_output = io.TextIOWrapper(output.file, encoding="utf-8", newline="")
+    writer = csv.writer(text_output)
+    rows = stream_rows(query, params)
+    writer.writerow(next(rows))
+    for chunk in rows:
+        writer.writerows(chunk)
+    text_output.flush()
+    text_output.detach()
+    return open_export(output)
+
+def export_xlsx(query, params=None):
+    # constant_memory flushes each row to disk as soon as the next one starts;
+    # results longer than one sheet continue on Sheet2, Sheet3, ...
+    output = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
+    workbook = xlsxwriter.Workbook(output, {
+        "constant_memory": True,
+        "remove_timezone": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+    rows = stream_rows(query, params)
+    columns = next(rows)
+    sheet, row_num = None, EXCEL_MAX_ROWS
+    for chunk in rows:
+        for row in chunk:
+            if row_num == EXCEL_MAX_ROWS:
+                sheet = workbook.add_worksheet()
+                sheet.write_row(0, 0, columns)
+                row_num = 1
+            sheet.write_row(row_num, 0, row)
+            row_num += 1
+    if sheet is None:
+        workbook.add_worksheet().write_row(0, 0, columns)
+    workbook.close()
+    return open_export(output)
+
+def download_buttons(query, params, basename, key):
+    path = f"{current_section.get()}/Export"
+    col1, col2 = st.columns(2)
+    col1.download_button(
+        "Download CSV", lambda: run_in_section(path, export_csv, query, params), f"{basename}.csv", "text/csv",
+        key=f"{key}_csv", on_click="ignore"
+    )
+    col2.download_button(
+        "Download Excel", lambda: run_in_section(path, export_xlsx, query, params), f"{basename}.xlsx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        key=f"{key}_xlsx", on_click="ignore"
+    )
+
+# --- Helper: Analytics Snapshot (Parquet + DuckDB) ---
+# The dashboard can run off a local columnar snapshot instead of Postgres. Snapshots
+# append rows past each table's commit-safe primary-key watermark (see safe_watermark)
+# as Hive-partitioned Parquet (products, small and frequently updated, is rewritten
+# whole). Updates to rows that were already exported (e.g. an order's status) show up
+# after a full re-export. A table written from scratch goes to a new directory that
+# replaces the old one only once every table is written, so readers never see it half
+# done; replaced directories are removed by the next snapshot. With [analytics]
+# snapshot_interval_seconds set, a background thread takes snapshots on that schedule.
+SNAPSHOT_TABLES = {
+    # table: (primary key, columns, partition expression or None)
+    "customers": ("customer_id", "customer_id, name, email, city, country, registration_date",
+                  "EXTRACT(YEAR FROM registration_date)::int::text"),
+    "orders": ("order_id", "order_id, customer_id, order_date, status", "TO_CHAR(order_date, 'YYYY-MM')"),
+    "order_items": ("order_item_id", "order_item_id, order_id, product_id, quantity, unit_price",
+                    "(order_id / 1000000)::text"),
+    "payments": ("payment_id", "payment_id, order_id, amount, payment_method, payment_date",
+                 "TO_CHAR(payment_date, 'YYYY-MM')"),
+    "products": ("product_id", "product_id, name, category, price", None),
+}
+SNAPSHOT_WAIT_SECONDS = 5.0
+SNAPSHOT_CHUNK_ROWS = 250_000
+
+# Same names and columns as DASHBOARD_QUERIES, answered from the raw snapshot tables.
+# Money is exported as float64 (see compact), hence the rounding.
+ANALYTICS_QUERIES = {
+    "Customer Insights": {
+        "total_customers": "SELECT COUNT(*) AS total_customers FROM customers",
+        "by_country": """
+            SELECT country, COUNT(*) AS num_customers FROM customers
+            GROUP BY country ORDER BY num_customers DESC
+        """,
+        "by_city": """
+            SELECT city, country, COUNT(*) AS num_customers FROM customers
+            GROUP BY city, country ORDER BY num_customers DESC LIMIT 10
+        """,
+        "top_spenders": """
+            SELECT c.customer_id, c.name, c.email, ROUND(SUM(p.amount), 2) AS total_spending
+            FROM customers c
+            JOIN orders o ON c.customer_id = o.customer_id
+            JOIN payments p ON o.order_id = p.order_id
+            GROUP BY c.customer_id, c.name, c.email
+            ORDER BY total_spending DESC, c.customer_id LIMIT 10
+        """,
+        "monthly_regs": """
+            SELECT strftime(registration_date, '%Y-%m') AS registration_month, COUNT(*) AS new_customers
+            FROM customers GROUP BY registration_month ORDER BY registration_month
+        """,
+        "yearly_regs": """
+            SELECT year(registration_date) AS registration_year, COUNT(*) AS new_customers
+            FROM customers GROUP BY registration_year ORDER BY registration_year
+        """,
+    },
+    "Orders Analysis": {
+        "order_status": "SELECT status, COUNT(*) AS count FROM orders GROUP BY status ORDER BY count DESC",
+        "orders_by_month": """
+            SELECT strftime(order_date, '%Y-%m') AS order_month, COUNT(*) AS num_orders
+            FROM orders GROUP BY order_month ORDER BY order_month
+        """,
+        "top_customers": """
+            SELECT c.customer_id, c.name, COUNT(o.order_id) AS total_orders
+            FROM customers c JOIN orders o ON c.customer_id = o.customer_id
+            GROUP BY c.customer_id, c.name ORDER BY total_orders DESC, c.customer_id LIMIT 10
+        """,
+    },
+    "Product Analysis": {
+        "top_products": """
+            SELECT p.product_id, p.name, SUM(oi.quantity)::BIGINT AS total_sold
+            FROM order_items oi JOIN products p ON oi.product_id = p.product_id
+            GROUP BY p.product_id, p.name ORDER BY total_sold DESC, p.product_id LIMIT 10
+        """,
+        "category_sales": """
+            SELECT p.category, SUM(oi.quantity)::BIGINT AS total_quantity
+            FROM order_items oi JOIN products p ON oi.product_id = p.product_id
+            GROUP BY p.category ORDER BY total_quantity DESC
+        """,
+    },
+    "Payment Insights": {
+        "payment_methods": """
+            SELECT payment_method, COUNT(*) AS num_payments FROM payments
+            GROUP BY payment_method ORDER BY num_payments DESC
+        """,
+        "monthly_revenue": """
+            SELECT strftime(payment_date, '%Y-%m') AS pay_month, ROUND(SUM(amount), 2) AS total_revenue
+            FROM payments GROUP BY pay_month ORDER BY pay_month
+        """,
+    },
+}
+
+class SnapshotStore:
+    def __init__(self, root, interval):
+        self.root = root
+        self.lock = threading.Lock()  # one snapshot at a time per process
+        self.state_path = os.path.join(root, "_snapshot.json")
+        self.db = duckdb.connect()
+        os.makedirs(root, exist_ok=True)
+        self.create_views()
+        if interval > 0:
+            threading.Thread(target=self.schedule, args=(interval,), name="snapshot-scheduler", daemon=True).start()
+
+    def state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"watermarks": {}, "pending": {}, "rows": {}, "dirs": {}, "taken_at": None}
+
+    def table_dir(self, state, table):
+        # Snapshots from before directories were swapped live in a directory named after the table
+        return os.path.join(self.root, state.get("dirs", {}).get(table, table))
+
+    def remove_unused(self, state):
+        # Directories replaced by an earlier snapshot, or left by an interrupted one
+        for table in SNAPSHOT_TABLES:
+            current = self.table_dir(state, table)
+            for path in glob.glob(os.path.join(self.root, table)) + glob.glob(os.path.join(self.root, f"{table}-*")):
+                if os.path.isdir(path) and path != current:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def schedule(self, interval):
+        # Takes a snapshot whenever the last one is older than the interval
+        while True:
+            wait = interval
+            try:
+                taken_at = self.state()["taken_at"]
+                age = (datetime.datetime.now() - datetime.datetime.fromisoformat(taken_at)).total_seconds() \
+                    if taken_at else interval
+                if age >= interval:
+                    self.take()
+                else:
+                    wait = interval - age
+            except Exception as e:
+                query_logger.warning("Could not take scheduled snapshot: %s", e)
+            time.sleep(max(wait, 1))
+
+    def save_state(self, state):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def take(self, full=False):
+        # Returns table -> rows exported by this run
+        with self.lock:
+            state = self.state()
+            state.setdefault("dirs", {})
+            state.setdefault("pending", {})
+            self.remove_unused(state)
+            exported = {}
+            replaced = {}  # table -> (directory, watermark, pending), swapped in at the end
+            for table, (pk, columns, partition) in SNAPSHOT_TABLES.items():
+                lo = 0 if full or partition is None else state["watermarks"].get(table, 0)
+                if lo == 0:
+                    table_dir = os.path.join(self.root, f"{table}-{uuid.uuid4().hex[:12]}")
+                else:
+                    table_dir = self.table_dir(state, table)
+                    # Leftovers of an interrupted run from this watermark are written again
+                    for leftover in glob.glob(os.path.join(table_dir, "**", f"part-{lo}-*.parquet"), recursive=True):
+                        os.remove(leftover)
+                with reader_for((table,)).connect() as conn:
+                    pending = None
+                    if partition is None:
+                        # Rewritten whole every time, so a late commit is picked up next time
+                        hi = conn.execute(text(f"SELECT COALESCE(MAX({pk}), 0) FROM {table}")).scalar()
+                    else:
+                        # Appended by watermark: only up to ids no in-flight writer can still
+                        # commit below (waits briefly for them, else leaves it pending)
+                        pending = state["pending"].get(table) if lo else None
+                        hi, pending = safe_watermark(conn, table, pk, tuple(pending) if pending else None,
+                                                     wait=SNAPSHOT_WAIT_SECONDS)
+                        hi = max(hi or 0, lo)
+                exported[table] = 0
+                if hi > lo:
+                    select_list = f"{columns}, {partition} AS part" if partition else columns
+                    rows = stream_rows(
+                        f"SELECT {select_list} FROM {table} WHERE {pk} > :lo AND {pk} <= :hi ORDER BY {pk}",
+                        {"lo": lo, "hi": hi}, chunk_rows=SNAPSHOT_CHUNK_ROWS,
+                    )
+                    names = next(rows)
+                    for n, chunk in enumerate(rows):
+                        batch = pa.Table.from_pandas(
+                            compact(pd.DataFrame.from_records(chunk, columns=names)), preserve_index=False
+                        )
+                        if partition:
+                            pq.write_to_dataset(batch, table_dir, partition_cols=["part"],
+                                                basename_template=f"part-{lo}-{n}-{{i}}.parquet")
+                        else:
+                            os.makedirs(table_dir, exist_ok=True)
+                            pq.write_table(batch, os.path.join(table_dir, f"part-{lo}-{n}.parquet"))
+                        exported[table] += batch.num_rows
+                if lo == 0:
+                    replaced[table] = (table_dir, hi, pending)
+                else:
+                    state["watermarks"][table] = hi
+                    state["pending"][table] = pending
+                    state["rows"][table] = state["rows"].get(table, 0) + exported[table]
+                    self.save_state(state)
+            for table, (table_dir, hi, pending) in replaced.items():
+                state["dirs"][table] = os.path.basename(table_dir)
+                state["watermarks"][table] = hi
+                state["pending"][table] = pending
+                state["rows"][table] = exported[table]
+            state["taken_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+            self.save_state(state)
+            self.create_views()
+        invalidate("snapshot")
+        return exported
+
+    def create_views(self):
+        state = self.state()
+        with self.db.cursor() as cursor:
+            for table, (_, _, partition) in SNAPSHOT_TABLES.items():
+                files = os.path.join(self.table_dir(state, table), "**", "*.parquet")
+                if not glob.glob(files, recursive=True):
+                    cursor.execute(f"DROP VIEW IF EXISTS {table}")
+                    continue
+                source = f"read_parquet('{files.replace(chr(39), chr(39) * 2)}', hive_partitioning = true, union_by_name = true)"
+                cursor.execute(
+                    f"CREATE OR REPLACE VIEW {table} AS SELECT * {'EXCLUDE (part)' if partition else ''} FROM {source}"
+                )
+
+    def ready(self):
+        return all(self.state()["watermarks"].get(table) for table in SNAPSHOT_TABLES)
+
+    def query(self, sql):
+        cursor = self.db.cursor()  # one DuckDB connection per calling thread
+        try:
+            return cursor.execute(sql).df()
+        finally:
+            cursor.close()
+
+@st.cache_resource
+def get_snapshot_store():
+    return SnapshotStore(
+        get_setting("analytics", "snapshot_dir", "snapshots"),
+        float(get_setting("analytics", "snapshot_interval_seconds", 0)),
+    )
+
+def snapshot_read(query, tables=("snapshot",), params=None, ttl=None):
+    # cached_read's counterpart for the snapshot; entries drop when a snapshot lands
+    key = ("snapshot", query)
+    df = query_cache.get(key)
+    if df is None:
+        generation = query_cache.generation(tables)
+        start = time.perf_counter()
+        df = compact(get_snapshot_store().query(query))
+        query_log.record("read", query, time.perf_counter() - start, len(df), database="snapshot")
+        query_cache.put(key, tables, generation, df, ttl)
+    else:
+        query_log.record("cache hit", query, 0.0, len(df))
+    return df
 
 # --- Streamlit UI ---
 st.title("📦 Amazon")
 
-menu = ["View Products", "Place Order", "Order History", "Track Orders", "Admin Panel"]
+menu = ["View Products", "Place Order", "Bulk Orders", "Order History", "Track Orders", "Admin Panel"]
+if st.query_params.get("diagnostics") == "1" or get_setting("diagnostics", "show_page", False):
+    menu.append("Diagnostics")
 choice = st.sidebar.selectbox("Navigation", menu)
+current_section.set(choice)
 
 # --- View Products ---
 if choice == "View Products":
     st.subheader("📋 Available Products")
     try:
-        with engine.connect() as conn:
-            df = pd.read_sql(text("SELECT * FROM products"), conn)
+        product_columns = get_table_columns("products")
+
+        col1, col2 = st.columns([3, 1])
+        search_term = col1.text_input("Search Product")
+        match_mode = col2.radio("Match", ["Contains", "Starts with"], horizontal=True)
+
+        col3, col4 = st.columns([3, 1])
+        shown_columns = col3.multiselect("Columns", product_columns, default=product_columns)
+        page_size = col4.selectbox("Rows per page", PAGE_SIZES, index=1)
 
-        search_term = st.text_input("Search Product")
-        if search_term:
-            df = df[df['name'].str.contains(search_term, case=False, na=False)]
+        # Cursor stack: the last product_id of every page visited so far
+        query_key = (search_term, match_mode, page_size)
+        if st.session_state.get("products_query") != query_key:
+            st.session_state["products_query"] = query_key
+            st.session_state["products_cursors"] = [None]
+        cursors = st.session_state["products_cursors"]
+
+        df, has_next = search_products(
+            [c for c in shown_columns if c in product_columns],
+            term=search_term, match=match_mode, after_id=cursors[-1], limit=page_size
+        )
+        last_id = int(df["product_id"].iloc[-1]) if not df.empty else None
+        if "product_id" not in shown_columns:
+            df = df.drop(columns="product_id")
 
         st.dataframe(df)
 
-        csv = df.to_csv(index=False).encode('utf-8')
-        excel_data = convert_df_to_excel(df)
+        def next_page(after_id):
+            st.session_state["products_cursors"].append(after_id)
+
+        def prev_page():
+            st.session_state["products_cursors"].pop()
 
-        st.download_button("Download CSV", csv, "products.csv", "text/csv")
+        nav1, nav2, nav3 = st.columns([1, 1, 4])
+        nav1.button("⬅️ Previous", on_click=prev_page, disabled=len(cursors) <= 1)
+        nav2.button("Next ➡️", on_click=next_page, args=(last_id,), disabled=not has_next)
+        nav3.caption(f"Page {len(cursors)} · {len(df)} rows")
+
+        # Exports cover every page of the current search, not just the visible one
+        export_query, export_params = product_search_query(
+            [c for c in shown_columns if c in product_columns], term=search_term, match=match_mode
+        )
+        download_buttons(export_query, export_params, "products", key="products_export")
 
     except Exception as e:
         st.error(f"Error loading products: {e}")
@@ -71,57 +2323,209 @@ if choice == "View Products":
 elif choice == "Place Order":
     st.subheader("🛒 Place New Order")
     try:
-        with engine.connect() as conn:
-            customers_df = pd.read_sql(text("SELECT customer_id, name AS fullname FROM customers"), conn)
-            customer_map = {f"{row.fullname} (ID: {row.customer_id})": row.customer_id for row in customers_df.itertuples()}
-            customer_choice = st.selectbox("Select Customer", list(customer_map.keys()))
+        # Options are the current matches plus whatever is already selected
+        customer_term = st.text_input("Search Customer", placeholder="Name prefix or customer ID")
+        customer_options = remember_labels("customer", typeahead("customers", "customer_id", customer_term))
+        current_customer = st.session_state.get("order_customer")
+        if current_customer is not None and current_customer not in customer_options:
+            customer_options.insert(0, current_customer)
+        customer_choice = st.selectbox("Select Customer", customer_options, key="order_customer")
 
-            products_df = pd.read_sql(text("SELECT product_id, name FROM products"), conn)
-            product_map = {f"{row.name} (ID: {row.product_id})": row.product_id for row in products_df.itertuples()}
-            selected_products = st.multiselect("Select Products", list(product_map.keys()))
-            quantities = [st.number_input(f"Quantity for {prod}", min_value=1, step=1, key=prod) for prod in selected_products]
+        product_term = st.text_input("Search Product", placeholder="Name prefix or product ID")
+        product_matches = remember_labels("product", typeahead("products", "product_id", product_term))
+        current_products = st.session_state.get("order_products", [])
+        product_options = current_products + [p for p in product_matches if p not in current_products]
+        selected_products = st.multiselect("Select Products", product_options, key="order_products")
+        quantities = [st.number_input(f"Quantity for {prod}", min_value=1, step=1, key=prod) for prod in selected_products]
 
         if st.button("Place Order"):
-            if selected_products and quantities:
-                customer_id = customer_map[customer_choice]
-                product_ids = [product_map[p] for p in selected_products]
+            if customer_choice and selected_products and quantities:
+                customer_id = st.session_state["customer_label_ids"][customer_choice]
+                product_ids = [st.session_state["product_label_ids"][p] for p in selected_products]
+                # One idempotency key per cart: clicking again resubmits the same order,
+                # which is recognised instead of placed twice. A failed order gets a fresh key.
+                draft = (customer_id, tuple(product_ids), tuple(int(q) for q in quantities))
+                submission = st.session_state.get("order_submission")
+                if submission is None or submission["draft"] != draft or submission.get("status") == "failed":
+                    submission = {"key": str(uuid.uuid4()), "draft": draft}
+                    st.session_state["order_submission"] = submission
                 try:
-                    with engine.begin() as conn:
-                        conn.execute(
-                            text("CALL PlaceMultiProductOrder(:customer_id, :product_ids, :qtys)"),
-                            {"customer_id": customer_id, "product_ids": product_ids, "qtys": quantities}
-                        )
-                    st.success("✅ Order placed successfully!")
+                    order_queue.submit(submission["key"], customer_id, product_ids, quantities)
                 except Exception as e:
                     st.error(f"❌ Error placing order: {e}")
             else:
                 st.warning("⚠️ Please select products and quantities.")
+
+        def new_order():
+            st.session_state.pop("order_submission", None)
+            st.session_state["order_products"] = []
+
+        def render_submission():
+            current_section.set(choice)  # fragment reruns start from a fresh context
+            submission = st.session_state["order_submission"]
+            try:
+                state = order_queue.status(submission["key"])
+            except Exception as e:
+                st.error(f"❌ Error checking order status: {e}")
+                return
+            previous, submission["status"] = submission.get("status"), state["status"]
+            if state["status"] == "placed":
+                st.success(f"✅ Order #{state['order_id']} placed successfully!")
+                st.button("🆕 New order", on_click=new_order)
+            elif state["status"] == "failed":
+                st.error(f"❌ Error placing order: {state['error']}")
+            elif state["status"] == "processing":
+                st.info("⚙️ Placing your order...")
+            else:
+                st.info("⏳ Order queued...")
+            if previous in (None, "queued", "processing") and state["status"] in ("placed", "failed"):
+                st.rerun()  # settled: redraw the page once, without polling
+
+        # Poll a pending submission until it is placed or has failed
+        submission = st.session_state.get("order_submission")
+        if submission is not None:
+            if submission.get("status") in ("placed", "failed"):
+                render_submission()
+            else:
+                st.fragment(render_submission, run_every=float(get_setting("orders", "poll_seconds", 1)))()
     except Exception as e:
         st.error(f"❌ Error loading customer/product data: {e}")
 
+# --- Bulk Orders ---
+elif choice == "Bulk Orders":
+    st.subheader("📥 Bulk Order Ingestion")
+    st.caption(
+        "CSV or Parquet with `customer_id`, `product_id`, `quantity` and an optional `order_ref`. "
+        "Without `order_ref`, consecutive lines for the same customer form one order."
+    )
+    uploaded = st.file_uploader("Order lines", type=["csv", "parquet"])
+    col1, col2 = st.columns(2)
+    batch_size = col1.number_input(
+        "Orders per transaction", min_value=1, max_value=5000, step=50,
+        value=int(get_setting("bulk_orders", "batch_size", 200))
+    )
+    workers = col2.number_input(
+        "Parallel transactions", min_value=1, max_value=8, step=1,
+        value=int(get_setting("bulk_orders", "workers", 4))
+    )
+
+    if uploaded is not None and st.button("🚀 Ingest Orders"):
+        try:
+            orders, failures = group_order_lines(read_order_lines(uploaded))
+        except Exception as e:
+            st.error(f"❌ Error reading order file: {e}")
+        else:
+            batches = [orders[i:i + batch_size] for i in range(0, len(orders), batch_size)]
+            progress = st.progress(0.0)
+            status = st.empty()
+            done_orders = done_lines = failed_orders = 0
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest") as executor:
+                futures = {
+                    executor.submit(run_in_section, current_section.get(), submit_order_batch, batch): batch
+                    for batch in batches
+                }
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    batch_failures = future.result()
+                    failures += batch_failures
+                    failed_orders += len(batch_failures)
+                    done_orders += len(batch)
+                    done_lines += sum(order["lines"] for order in batch)
+                    elapsed = time.perf_counter() - start
+                    progress.progress(done_orders / len(orders))
+                    status.caption(
+                        f"{done_orders:,}/{len(orders):,} orders · {done_lines / elapsed:,.0f} rows/sec"
+                    )
+            elapsed = time.perf_counter() - start
+            invalidate("orders", "order_items", "payments", "products")
+
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("Orders placed", f"{len(orders) - failed_orders:,}")
+            m2.metric("Failures", f"{len(failures):,}")
+            m3.metric("Rows/sec", f"{done_lines / elapsed:,.0f}" if elapsed > 0 else "-")
+            m4.metric("Elapsed", f"{elapsed:,.1f} s")
+            if failures:
+                failures_df = pd.DataFrame(failures)
+                st.dataframe(failures_df)
+                st.download_button(
+                    "Download failures", failures_df.to_csv(index=False).encode('utf-8'),
+                    "order_failures.csv", "text/csv"
+                )
+            else:
+                st.success("✅ All orders placed!")
+
 # --- Order History ---
 elif choice == "Order History":
     st.subheader("📜 Order History")
     try:
-        query = """
-            SELECT o.order_id, c.name AS customer, o.order_date, p.name AS product,
-                   oi.quantity, oi.unit_price, (oi.quantity * oi.unit_price) AS total_amount
-            FROM orders o
-            JOIN customers c ON o.customer_id = c.customer_id
-            JOIN order_items oi ON oi.order_id = o.order_id
-            JOIN products p ON oi.product_id = p.product_id
-            ORDER BY o.order_date DESC
-            LIMIT 50
-        """
-        with engine.connect() as conn:
-            df = pd.read_sql(text(query), conn)
+        # Filters: customer/product typeaheads like Place Order, dates, statuses
+        col1, col2 = st.columns(2)
+        customer_term = col1.text_input("Search Customer", placeholder="Name prefix or customer ID", key="history_customer_term")
+        customer_options = ["All customers"] + remember_labels(
+            "customer", typeahead("customers", "customer_id", customer_term)
+        )
+        current_customer = st.session_state.get("history_customer")
+        if current_customer is not None and current_customer not in customer_options:
+            customer_options.insert(1, current_customer)
+        customer_choice = col1.selectbox("Customer", customer_options, key="history_customer")
 
-        st.dataframe(df)
+        product_term = col2.text_input("Search Product", placeholder="Name prefix or product ID", key="history_product_term")
+        product_options = ["All products"] + remember_labels(
+            "product", typeahead("products", "product_id", product_term)
+        )
+        current_product = st.session_state.get("history_product")
+        if current_product is not None and current_product not in product_options:
+            product_options.insert(1, current_product)
+        product_choice = col2.selectbox("Product", product_options, key="history_product")
+
+        col3, col4, col5, col6 = st.columns([1, 1, 2, 1])
+        date_from = col3.date_input("From", value=None, key="history_from")
+        date_to = col4.date_input("To", value=None, key="history_to")
+        statuses = col5.multiselect("Status", order_statuses(), key="history_status")
+        page_size = col6.selectbox("Rows per page", PAGE_SIZES, index=1, key="history_page_size")
+
+        filters = {
+            "customer_id": st.session_state.get("customer_label_ids", {}).get(customer_choice),
+            "product_id": st.session_state.get("product_label_ids", {}).get(product_choice),
+            "date_from": date_from,
+            "date_to": date_to,
+            "statuses": statuses,
+        }
+
+        # Cursor stack: the (order_date, order_id, order_item_id) of every page's last line
+        query_key = (repr(sorted(filters.items())), page_size)
+        if st.session_state.get("history_query") != query_key:
+            st.session_state["history_query"] = query_key
+            st.session_state["history_cursors"] = [None]
+        cursors = st.session_state["history_cursors"]
+
+        df, has_next = search_order_history(filters, after=cursors[-1], limit=page_size)
+        last_key = None
+        if not df.empty:
+            last = df.iloc[-1]
+            last_key = (last["order_date"].to_pydatetime(), int(last["order_id"]), int(last["order_item_id"]))
+        st.dataframe(df.drop(columns="order_item_id"))
 
-        csv = df.to_csv(index=False).encode('utf-8')
-        excel_data = convert_df_to_excel(df)
+        def next_page(after):
+            st.session_state["history_cursors"].append(after)
 
-        st.download_button("Download CSV", csv, "order_history.csv", "text/csv")
+        def prev_page():
+            st.session_state["history_cursors"].pop()
+
+        export_query, export_params = order_history_query(filters)
+        if has_next or len(cursors) > 1:
+            total = f"≈ {estimate_rows(export_query, export_params, HISTORY_TABLES):,} lines"
+        else:
+            total = f"{len(df)} lines"
+
+        nav1, nav2, nav3 = st.columns([1, 1, 4])
+        nav1.button("⬅️ Previous", on_click=prev_page, disabled=len(cursors) <= 1, key="history_prev")
+        nav2.button("Next ➡️", on_click=next_page, args=(last_key,), disabled=not has_next, key="history_next")
+        nav3.caption(f"Page {len(cursors)} · {total}")
+
+        # Export every line matching the filters, streamed from the read model
+        download_buttons(export_query, export_params, "order_history", key="history_export")
 
     except Exception as e:
         st.error(f"❌ Error fetching order history: {e}")
@@ -129,345 +2533,419 @@ elif choice == "Order History":
 # --- Real-Time Order Tracking ---
 elif choice == "Track Orders":
     st.subheader("📡 Real-Time Order Tracking")
-    try:
-        query = """
-            SELECT o.order_id, c.name AS customer, o.order_date, p.name AS product,
-                   oi.quantity, oi.unit_price, (oi.quantity * oi.unit_price) AS total_amount
-            FROM orders o
-            JOIN customers c ON o.customer_id = c.customer_id
-            JOIN order_items oi ON oi.order_id = o.order_id
-            JOIN products p ON oi.product_id = p.product_id
-            WHERE o.order_date >= CURRENT_DATE - INTERVAL '1 day'
-            ORDER BY o.order_date DESC
-        """
-        with engine.connect() as conn:
-            df = pd.read_sql(text(query), conn)
-        st.dataframe(df)
-    except Exception as e:
-        st.error(f"❌ Error fetching live orders: {e}")
+
+    col1, col2, col3 = st.columns(3)
+    live = col1.toggle("Live mode")
+    source = col2.radio("Updates", ["Polling", "Push (LISTEN/NOTIFY)"], disabled=not live)
+    interval = col3.number_input(
+        "Poll every (seconds)", min_value=1, step=1,
+        value=int(get_setting("tracking", "poll_seconds", 5)), disabled=not live or source != "Polling"
+    )
+    max_rows = int(get_setting("tracking", "max_rows", 5000))
+    push = live and source != "Polling"
+
+    def render_tracking():
+        current_section.set(choice)  # fragment reruns start from a fresh context
+        try:
+            listener = get_order_listener() if push else None
+            if listener is not None and listener.error is not None:
+                st.warning(f"⚠️ Push updates unavailable, polling instead: {listener.error}")
+            # In push mode the database is only queried once an order above the
+            # watermark was announced, or while a watermark candidate is pending
+            if (listener is None or listener.error is not None or "track_rows" not in st.session_state
+                    or listener.latest_id > st.session_state.get("track_last_id", 0)
+                    or st.session_state.get("track_pending") is not None):
+                poll_tracked_orders(max_rows)
+            rows = st.session_state["track_rows"]
+            st.dataframe(rows)
+            st.caption(
+                f"{len(rows)} rows · last order #{rows['order_id'].max() if not rows.empty else '-'} · "
+                f"checked {datetime.datetime.now():%H:%M:%S}"
+            )
+        except Exception as e:
+            st.error(f"❌ Error fetching live orders: {e}")
+
+    if live:
+        st.fragment(render_tracking, run_every=1 if push else interval)()
+    else:
+        render_tracking()
 
 # --- Admin Panel ---
 elif choice == "Admin Panel":
     st.subheader("👨‍💼 Admin Panel")
-    tab1, tab2, tab3 = st.tabs(["Add Product", "Add Customer", "Dashboard"])
+    # Only the open tab runs (and queries); switching tabs reruns the page
+    tab1, tab2, tab3 = st.tabs(["Add Product", "Add Customer", "Dashboard"], key="admin_tab", on_change="rerun")
 
 # --- Add Product Tab ---
-    with tab1:
-        st.markdown("### ➕ Add Product")
-        mode = st.radio("Select Mode", ["New Product", "Existing Product"])
+    if tab1.open:
+        with tab1, query_section("Add Product"):
+            st.markdown("### ➕ Add Product")
+            mode = st.radio("Select Mode", ["New Product", "Existing Product", "Bulk Import"])
     
-        # Load categories and products
-        try:
-            with engine.connect() as conn:
-                categories_df = pd.read_sql("SELECT DISTINCT category FROM products", conn)
-                product_list_df = pd.read_sql("SELECT * FROM products ORDER BY name", conn)
-        except Exception as e:
-            st.error(f"Error loading data: {e}")
-            categories_df = pd.DataFrame({"category": []})
-            product_list_df = pd.DataFrame(columns=["name", "price", "stock_quantity", "product_id", "category"])
+            # Load only what the chosen mode needs
+            try:
+                categories_df = pd.DataFrame({"category": []})
+                product_list_df = pd.DataFrame(columns=["name", "price", "stock_quantity", "product_id", "category"])
+                if mode == "New Product":
+                    categories_df = memo_read("SELECT DISTINCT category FROM products", tables=("products",))
+                elif mode == "Existing Product":
+                    product_list_df = memo_read(
+                        "SELECT product_id, name, category, price FROM products ORDER BY name", tables=("products",)
+                    )
+            except Exception as e:
+                st.error(f"Error loading data: {e}")
+    
+            if mode == "New Product":
+                with st.form(key="new_product_form", clear_on_submit=True):
+                    name = st.text_input("Product Name", key="new_name")
+                    category = st.selectbox("Category", categories_df['category'].unique(), key="new_category")
+                    price = st.number_input("Price", min_value=0.0, step=0.01, key="new_price")
+                    quantity = st.number_input("Stock Quantity", min_value=0, step=1, key="new_quantity")
+                    submit = st.form_submit_button("Add New Product")
     
-        if mode == "New Product":
-            with st.form(key="new_product_form", clear_on_submit=True):
-                name = st.text_input("Product Name", key="new_name")
-                category = st.selectbox("Category", categories_df['category'].unique(), key="new_category")
-                price = st.number_input("Price", min_value=0.0, step=0.01, key="new_price")
-                quantity = st.number_input("Stock Quantity", min_value=0, step=1, key="new_quantity")
-                submit = st.form_submit_button("Add New Product")
+                if submit:
+                    if name and category:
+                        try:
+                            with engine.begin() as conn:
+                                conn.execute(
+                                    text("""
+                                        INSERT INTO products (name, category, price, stock_quantity) 
+                                        VALUES (:name, :category, :price, :quantity)
+                                    """),
+                                    {
+                                        "name": name,
+                                        "category": category,
+                                        "price": price,
+                                        "quantity": quantity
+                                    }
+                                )
+                            invalidate("products")
+                            st.success("✅ New product added!")
+                        except Exception as e:
+                            st.error(f"Error adding product: {e}")
+                    else:
+                        st.warning("Please fill all required fields.")
     
-            if submit:
-                if name and category:
+            elif mode == "Bulk Import":
+                bulk_import_form("products")
+
+            else:  # Existing Product
+                existing_product = st.selectbox("Select Existing Product", product_list_df['name'], key="existing_product")
+                if not product_list_df.empty:
+                    selected = product_list_df[product_list_df['name'] == existing_product].iloc[0]
+    
+                    with st.form(key="update_product_form", clear_on_submit=True):
+                        st.text_input("Category", value=selected['category'], disabled=True)
+                        price = st.number_input("Price", min_value=0.0, step=0.01, value=float(selected['price']), key="update_price")
+                        quantity = st.number_input("Add Quantity", min_value=0, step=1, key="update_quantity")
+                        update_submit = st.form_submit_button("Update Existing Product")
+    
+                    if update_submit:
+                        try:
+                            with engine.begin() as conn:
+                                conn.execute(
+                                    text("""
+                                        UPDATE products 
+                                        SET price = :price,
+                                            stock_quantity = stock_quantity + :quantity 
+                                        WHERE product_id = :pid
+                                    """),
+                                    {
+                                        "price": float(price),
+                                        "quantity": int(quantity),
+                                        "pid": int(selected['product_id'])
+                                    }
+                                )
+                            invalidate("products")
+                            st.success("✅ Product updated successfully.")
+                        except Exception as e:
+                            st.error(f"Error updating product: {e}")
+    
+            # Show current products (loaded when the expander is opened)
+            product_listing = st.expander("📦 Current Product List", key="admin_products_list", on_change="rerun")
+            if product_listing.open:
+                with product_listing:
                     try:
-                        with engine.begin() as conn:
-                            conn.execute(
-                                text("""
-                                    INSERT INTO products (name, category, price, stock_quantity) 
-                                    VALUES (:name, :category, :price, :quantity)
-                                """),
-                                {
-                                    "name": name,
-                                    "category": category,
-                                    "price": price,
-                                    "quantity": quantity
-                                }
-                            )
-                        st.success("✅ New product added!")
+                        df = memo_read(
+                            "SELECT product_id, name, category, price, stock_quantity FROM products ORDER BY product_id DESC",
+                            tables=("products",)
+                        )
+                        st.dataframe(df)
                     except Exception as e:
-                        st.error(f"Error adding product: {e}")
-                else:
-                    st.warning("Please fill all required fields.")
+                        st.error(f"Error loading products: {e}")
     
-        else:  # Existing Product
-            existing_product = st.selectbox("Select Existing Product", product_list_df['name'], key="existing_product")
-            if not product_list_df.empty:
-                selected = product_list_df[product_list_df['name'] == existing_product].iloc[0]
     
-                with st.form(key="update_product_form", clear_on_submit=True):
-                    st.text_input("Category", value=selected['category'], disabled=True)
-                    price = st.number_input("Price", min_value=0.0, step=0.01, value=float(selected['price']), key="update_price")
-                    quantity = st.number_input("Add Quantity", min_value=0, step=1, key="update_quantity")
-                    update_submit = st.form_submit_button("Update Existing Product")
+    # ---------------- TAB 2: CUSTOMER ----------------
+    if tab2.open:
+        with tab2, query_section("Add Customer"):
+            st.markdown("### 🧍 Add New Customer")
+    
+            with st.form("add_customer_form", clear_on_submit=True):
+                customer_name = st.text_input("Customer Name", key="customer_name")
+                email = st.text_input("Email", key="customer_email")
+                city = st.text_input("City", key="customer_city")
+                country = st.text_input("Country", key="customer_country")
+                registration_date = st.date_input("Registration Date", value=datetime.date.today(), key="customer_reg_date")
+                add_cust_submit = st.form_submit_button("Add Customer")
     
-                if update_submit:
+            if add_cust_submit:
+                if customer_name and email and city and country:
                     try:
                         with engine.begin() as conn:
                             conn.execute(
                                 text("""
-                                    UPDATE products 
-                                    SET price = :price,
-                                        stock_quantity = stock_quantity + :quantity 
-                                    WHERE product_id = :pid
+                                    INSERT INTO customers (name, email, city, country, registration_date)
+                                    VALUES (:name, :email, :city, :country, :registration_date)
                                 """),
                                 {
-                                    "price": float(price),
-                                    "quantity": int(quantity),
-                                    "pid": int(selected['product_id'])
+                                    "name": customer_name,
+                                    "email": email,
+                                    "city": city,
+                                    "country": country,
+                                    "registration_date": registration_date
                                 }
                             )
-                        st.success("✅ Product updated successfully.")
+                        invalidate("customers")
+                        st.success("✅ Customer added!")
                     except Exception as e:
-                        st.error(f"Error updating product: {e}")
-    
-        # Show current products
-        try:
-            with engine.connect() as conn:
-                df = pd.read_sql("SELECT * FROM products ORDER BY product_id DESC", conn)
-                st.markdown("### 📦 Current Product List")
-                st.dataframe(df)
-        except Exception as e:
-            st.error(f"Error loading products: {e}")
-    
-    
-    # ---------------- TAB 2: CUSTOMER ----------------
-    with tab2:
-        st.markdown("### 🧍 Add New Customer")
-    
-        with st.form("add_customer_form", clear_on_submit=True):
-            customer_name = st.text_input("Customer Name", key="customer_name")
-            email = st.text_input("Email", key="customer_email")
-            city = st.text_input("City", key="customer_city")
-            country = st.text_input("Country", key="customer_country")
-            registration_date = st.date_input("Registration Date", value=datetime.date.today(), key="customer_reg_date")
-            add_cust_submit = st.form_submit_button("Add Customer")
+                        st.error(f"❌ Error adding customer: {e}")
+                else:
+                    st.warning("Please fill all required fields.")
+
+            with st.expander("📤 Bulk Import Customers"):
+                bulk_import_form("customers")
     
-        if add_cust_submit:
-            if customer_name and email and city and country:
-                try:
-                    with engine.begin() as conn:
-                        conn.execute(
-                            text("""
-                                INSERT INTO customers (name, email, city, country, registration_date)
-                                VALUES (:name, :email, :city, :country, :registration_date)
-                            """),
-                            {
-                                "name": customer_name,
-                                "email": email,
-                                "city": city,
-                                "country": country,
-                                "registration_date": registration_date
-                            }
+            # Show all customers (loaded when the expander is opened)
+            customer_listing = st.expander("📋 Current Customers", key="admin_customers_list", on_change="rerun")
+            if customer_listing.open:
+                with customer_listing:
+                    try:
+                        customers_df = memo_read(
+                            """
+                            SELECT customer_id, name, email, city, country, registration_date
+                            FROM customers ORDER BY customer_id DESC
+                            """,
+                            tables=("customers",)
                         )
-                    st.success("✅ Customer added!")
+                        st.dataframe(customers_df)
+                    except Exception as e:
+                        st.error(f"❌ Error loading customers: {e}")
+
+    # --- Placeholder Dashboard tab ---
+    if tab3.open:
+        with tab3, query_section("Dashboard"):
+            st.markdown("### 📊 Data-Driven Insights")
+            snapshots = get_snapshot_store()
+            source = st.radio(
+                "Analytics source", ["Live database", "Parquet snapshot"], horizontal=True, key="dash_source",
+            )
+            use_snapshot = source == "Parquet snapshot"
+
+            col1, col2, col3, col4 = st.columns([1, 1, 1, 3])
+            if use_snapshot:
+                # Export rows added since the last snapshot (or everything) to local Parquet;
+                # scheduled snapshots run in the background (see SnapshotStore.schedule)
+                try:
+                    exported = None
+                    if col2.button("♻️ Full re-export"):
+                        with st.spinner("Exporting all rows to Parquet..."):
+                            exported = snapshots.take(full=True)
+                    elif col1.button("📸 Snapshot now"):
+                        with st.spinner("Exporting new rows to Parquet..."):
+                            exported = snapshots.take()
+                    state = snapshots.state()
+                    if exported:
+                        col4.caption("Exported: " + ", ".join(f"{n} {table}" for table, n in exported.items()))
+                    elif state["taken_at"]:
+                        col4.caption(f"Snapshot of {state['taken_at']} · {sum(state['rows'].values()):,} rows")
                 except Exception as e:
-                    st.error(f"❌ Error adding customer: {e}")
+                    st.error(f"❌ Error taking snapshot: {e}")
+                dashboard_queries = {
+                    title: {name: (sql, ("snapshot",)) for name, sql in queries.items()}
+                    for title, queries in ANALYTICS_QUERIES.items()
+                }
             else:
-                st.warning("Please fill all required fields.")
+                # Fold new rows into the rollup tables the dashboard reads from
+                try:
+                    if col1.button("🔄 Refresh now"):
+                        get_rollup_state()["last_refresh"] = 0.0
+                    if col2.button("🧮 Rebuild"):
+                        folded = rebuild_rollups()
+                        get_rollup_state()["last_refresh"] = time.monotonic()
+                    else:
+                        folded = maybe_refresh_rollups()
+                    if folded:
+                        col4.caption("Folded in: " + ", ".join(f"{n} {source}" for source, n in folded.items()))
+                except Exception as e:
+                    st.error(f"❌ Error refreshing rollups: {e}")
+                # Leaderboards are kept current by triggers; this checks them against the raw tables
+                if col3.button("✅ Verify totals", help="Compare leaderboard totals with the raw tables and correct any that differ"):
+                    try:
+                        with st.spinner("Checking leaderboard totals..."):
+                            mismatches = verify_leaderboards(repair=True)
+                        if mismatches.empty:
+                            st.success("✅ Leaderboard totals match the raw tables.")
+                        else:
+                            st.warning(f"⚠️ {len(mismatches):,} total(s) differed and were corrected.")
+                            st.dataframe(mismatches)
+                    except Exception as e:
+                        st.error(f"❌ Error verifying leaderboards: {e}")
+                dashboard_queries = DASHBOARD_QUERIES
     
-        # Show all customers
-        try:
-            with engine.connect() as conn:
-                customers_df = pd.read_sql(text("SELECT * FROM customers ORDER BY customer_id DESC"), conn)
-            st.markdown("### 📋 Current Customers")
-            st.dataframe(customers_df)
-        except Exception as e:
-            st.error(f"❌ Error loading customers: {e}")
+            # Expandable Insight Sections: only open ones run their queries, dispatched together
+            expanders = {
+                "Customer Insights": st.expander("### 👥 Customer Insights", key="dash_customers", on_change="rerun"),
+                "Orders Analysis": st.expander("#### 📦 Orders Analysis", key="dash_orders", on_change="rerun"),
+                "Product Analysis": st.expander("#### 🛍️ Product Analysis", key="dash_products", on_change="rerun"),
+                "Payment Insights": st.expander("#### 💳 Payment Insights", key="dash_payments", on_change="rerun"),
+            }
+            open_sections = [title for title, expander in expanders.items() if expander.open]
+            if use_snapshot and not snapshots.ready():
+                st.info("No snapshot yet: take one to answer the dashboard from Parquet.")
+                open_sections = []
+            results = run_queries_concurrently(
+                {name: query for title in open_sections for name, query in dashboard_queries[title].items()},
+                sections={name: title for title in open_sections for name in dashboard_queries[title]},
+                memoize=True,
+                reader=snapshot_read if use_snapshot else None,
+            )
 
-    # --- Placeholder Dashboard tab ---
-    with tab3:
-        st.markdown("### 📊 Data-Driven Insights")
-    
-        # Expandable Insight Sections
-        with st.expander("### 👥 Customer Insights", expanded=False):
-            try:
-                with engine.connect() as conn:
-                    total_customers = pd.read_sql(
-                        "SELECT COUNT(DISTINCT customer_id) AS total_customers FROM customers", conn)
-                    st.markdown("Total Customers: {total_customers.at[0, 'total_customers']}")
+            if "Customer Insights" in open_sections:
+                with expanders["Customer Insights"]:
+                    show_result(results, "total_customers", None,
+                                lambda df: st.markdown(f"Total Customers: {df.at[0, 'total_customers']}"))
     
                     # 🔹 Visual Divider
                     st.markdown("---")
-    
-                    by_country = pd.read_sql(
-                        """
-                        SELECT country, COUNT(customer_id) AS num_customers
-                        FROM customers
-                        GROUP BY country
-                        ORDER BY num_customers DESC
-                        """,
-                        conn
-                    )
-                    st.write("### 🏙️ Customers by Country")
-                    st.bar_chart(by_country.set_index("country"))
+                    show_result(results, "by_country", "### 🏙️ Customers by Country",
+                                lambda df: st.bar_chart(df.set_index("country")))
     
                     # 🔹 Visual Divider
                     st.markdown("---")
-    
-                    by_city = pd.read_sql(
-                        """
-                        SELECT city, country, COUNT(customer_id) AS num_customers
-                        FROM customers
-                        GROUP BY city, country
-                        ORDER BY num_customers DESC
-                        LIMIT 10
-                        """,
-                        conn
-                    )
-                    st.write("### 🏙️ Top 10 Cities by Customers")
-                    st.dataframe(by_city)
+                    show_result(results, "by_city", "### 🏙️ Top 10 Cities by Customers", st.dataframe)
     
                     # 🔹 Visual Divider
                     st.markdown("---")
-    
-                    top_spenders = pd.read_sql("""
-                        SELECT
-                            c.customer_id,
-                            c.name,
-                            c.email,
-                            SUM(p.amount) AS total_spending
-                        FROM customers c
-                        JOIN orders o ON c.customer_id = o.customer_id
-                        JOIN payments p ON o.order_id = p.order_id
-                        GROUP BY c.customer_id, c.name, c.email
-                        ORDER BY total_spending DESC
-                        LIMIT 10
-                    """, conn)
-                    st.write("### 💰 Top 10 Customers by Spending")
-                    st.dataframe(top_spenders)
+                    show_result(results, "top_spenders", "### 💰 Top 10 Customers by Spending", st.dataframe)
     
                     # 🔹 Visual Divider
                     st.markdown("---")
-    
-                    monthly_regs = pd.read_sql("""
-                        SELECT
-                            TO_CHAR(registration_date, 'YYYY-MM') AS registration_month,
-                            COUNT(customer_id) AS new_customers
-                        FROM customers
-                        GROUP BY registration_month
-                        ORDER BY registration_month
-                    """, conn)
-                    st.write("### 📅 Monthly Customer Registrations")
-                    st.line_chart(monthly_regs.set_index("registration_month"))
+                    show_result(results, "monthly_regs", "### 📅 Monthly Customer Registrations",
+                                lambda df: st.line_chart(df.set_index("registration_month")))
     
                     # 🔹 Visual Divider
                     st.markdown("---")
+                    show_result(results, "yearly_regs", "### 🗓️ Yearly Customer Registrations",
+                                lambda df: st.bar_chart(df.set_index("registration_year")))
     
-                    yearly_regs = pd.read_sql("""
-                        SELECT
-                            EXTRACT(YEAR FROM registration_date) AS registration_year,
-                            COUNT(customer_id) AS new_customers
-                        FROM customers
-                        GROUP BY registration_year
-                        ORDER BY registration_year
-                    """, conn)
-                    st.write("### 🗓️ Yearly Customer Registrations")
-                    st.bar_chart(yearly_regs.set_index("registration_year"))
-    
-            except Exception as e:
-                st.error(f"❌ Error loading Customer Insights: {e}")
-    
-        with st.expander("#### 📦 Orders Analysis", expanded=False):
-            try:
-                with engine.connect() as conn:
-                    order_status = pd.read_sql("""
-                        SELECT status, COUNT(order_id) AS count
-                        FROM orders
-                        GROUP BY status
-                        ORDER BY count DESC
-                    """, conn)
-                    st.write("### 📦 Orders by Status")
-                    st.bar_chart(order_status.set_index("status"))
+            if "Orders Analysis" in open_sections:
+                with expanders["Orders Analysis"]:
+                    show_result(results, "order_status", "### 📦 Orders by Status",
+                                lambda df: st.bar_chart(df.set_index("status")))
     
                     # 🔹 Visual Divider
                     st.markdown("---")
-    
-                    orders_by_month = pd.read_sql("""
-                        SELECT TO_CHAR(order_date, 'YYYY-MM') AS order_month, COUNT(order_id) AS num_orders
-                        FROM orders
-                        GROUP BY order_month
-                        ORDER BY order_month
-                    """, conn)
-                    st.write("### 📅 Monthly Orders")
-                    st.line_chart(orders_by_month.set_index("order_month"))
+                    show_result(results, "orders_by_month", "### 📅 Monthly Orders",
+                                lambda df: st.line_chart(df.set_index("order_month")))
     
                     # 🔹 Visual Divider
                     st.markdown("---")
+                    show_result(results, "top_customers", "### 🏆 Top 10 Customers by Orders", st.dataframe)
     
-                    top_customers = pd.read_sql("""
-                        SELECT c.name, COUNT(o.order_id) AS total_orders
-                        FROM customers c
-                        JOIN orders o ON c.customer_id = o.customer_id
-                        GROUP BY c.name
-                        ORDER BY total_orders DESC
-                        LIMIT 10
-                    """, conn)
-                    st.write("### 🏆 Top 10 Customers by Orders")
-                    st.dataframe(top_customers)
-    
-            except Exception as e:
-                st.error(f"❌ Error loading Orders Analysis: {e}")
-    
-        with st.expander("#### 🛍️ Product Analysis", expanded=False):
-            try:
-                with engine.connect() as conn:
-                    top_products = pd.read_sql("""
-                        SELECT p.name, SUM(oi.quantity) AS total_sold
-                        FROM order_items oi
-                        JOIN products p ON oi.product_id = p.product_id
-                        GROUP BY p.name
-                        ORDER BY total_sold DESC
-                        LIMIT 10
-                    """, conn)
-                    st.write("### 🛍️ Top 10 Best-Selling Products")
-                    st.dataframe(top_products)
+            if "Product Analysis" in open_sections:
+                with expanders["Product Analysis"]:
+                    show_result(results, "top_products", "### 🛍️ Top 10 Best-Selling Products", st.dataframe)
     
                     # 🔹 Visual Divider
                     st.markdown("---")
+                    show_result(results, "category_sales", "### 🗂️ Sales by Product Category",
+                                lambda df: st.bar_chart(df.set_index("category")))
     
-                    category_sales = pd.read_sql("""
-                        SELECT category, SUM(oi.quantity) AS total_quantity
-                        FROM order_items oi
-                        JOIN products p ON oi.product_id = p.product_id
-                        GROUP BY category
-                        ORDER BY total_quantity DESC
-                    """, conn)
-                    st.write("### 🗂️ Sales by Product Category")
-                    st.bar_chart(category_sales.set_index("category"))
-    
-            except Exception as e:
-                st.error(f"❌ Error loading Product Analysis: {e}")
-    
-        with st.expander("#### 💳 Payment Insights", expanded=False):
-            try:
-                with engine.connect() as conn:
-                    payment_methods = pd.read_sql("""
-                        SELECT payment_method, COUNT(payment_id) AS num_payments
-                        FROM payments
-                        GROUP BY payment_method
-                        ORDER BY num_payments DESC
-                    """, conn)
-                    st.write("### 💳 Payment Methods Distribution")
-                    st.bar_chart(payment_methods.set_index("payment_method"))
+            if "Payment Insights" in open_sections:
+                with expanders["Payment Insights"]:
+                    show_result(results, "payment_methods", "### 💳 Payment Methods Distribution",
+                                lambda df: st.bar_chart(df.set_index("payment_method")))
     
                     # 🔹 Visual Divider
                     st.markdown("---")
-    
-                    monthly_revenue = pd.read_sql("""
-                        SELECT TO_CHAR(payment_date, 'YYYY-MM') AS pay_month, SUM(amount) AS total_revenue
-                        FROM payments
-                        GROUP BY pay_month
-                        ORDER BY pay_month
-                    """, conn)
-                    st.write("### 📈 Monthly Revenue")
-                    st.line_chart(monthly_revenue.set_index("pay_month"))
-    
-            except Exception as e:
-                st.error(f"❌ Error loading Payment Insights: {e}")
+                    show_result(results, "monthly_revenue", "### 📈 Monthly Revenue",
+                                lambda df: st.line_chart(df.set_index("pay_month")))
+
+# --- Diagnostics (hidden; open the app with ?diagnostics=1) ---
+elif choice == "Diagnostics":
+    st.subheader("🩺 Query Diagnostics")
+    records, slow_queries = query_log.snapshot()
+
+    pools = [f"primary: {engine.pool.status()}"]
+    if read_engine is not engine:
+        pools.append(f"replica: {read_engine.pool.status()}")
+    st.caption(" · ".join(pools))
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Recorded statements", f"{len(records):,}")
+    col2.metric("Cache hits / misses", f"{query_cache.hits:,} / {query_cache.misses:,}")
+    col3.metric("Slow queries", f"{len(slow_queries):,}", help=f"Threshold: {query_log.slow_ms:.0f} ms")
+    if st.button("🧹 Clear"):
+        query_log.clear()
+        st.rerun()
+
+    if records.empty:
+        st.info("No statements recorded yet.")
+    else:
+        sections = sorted(records["section"].unique())
+        chosen = st.multiselect("Sections", sections, default=sections)
+        records = records[records["section"].isin(chosen)]
+        records["ms"] = records["seconds"] * 1000
+        records["database"] = records["database"].fillna("-")  # cache hits never reach a server
+
+        st.write("### ⏱️ Time by Section")
+        by_section = records.groupby("section").agg(
+            statements=("ms", "size"), total_ms=("ms", "sum"), p95_ms=("ms", lambda ms: ms.quantile(0.95))
+        ).sort_values("total_ms", ascending=False)
+        st.dataframe(by_section)
+
+        st.write("### 🔎 Per Query (recent runs)")
+        per_query = records.groupby(["section", "kind", "database", "statement"]).agg(
+            calls=("ms", "size"),
+            p50_ms=("ms", "median"),
+            p95_ms=("ms", lambda ms: ms.quantile(0.95)),
+            max_ms=("ms", "max"),
+            rows=("rows", "mean"),
+            frame_bytes=("frame_bytes", "mean"),
+            errors=("error", "count"),
+        ).sort_values("p95_ms", ascending=False).reset_index()
+        st.dataframe(per_query)
+        st.caption("frame_bytes is the in-memory size of the DataFrame a read loaded through the cache, "
+                   "not bytes transferred; writes and streamed reads have none.")
+
+        st.write("### 🧠 Memory per Query (typed loading)")
+        loaded = records.dropna(subset=["raw_frame_bytes"])
+        if loaded.empty:
+            st.caption("No DataFrame loads recorded yet.")
+        else:
+            memory = loaded.groupby("statement").agg(
+                loads=("raw_frame_bytes", "size"), raw_bytes=("raw_frame_bytes", "last"),
+                typed_bytes=("frame_bytes", "last")
+            )
+            memory["saved_pct"] = (1 - memory["typed_bytes"] / memory["raw_bytes"]) * 100
+            st.metric("Saved on the latest load of each query",
+                      f"{(memory['raw_bytes'] - memory['typed_bytes']).sum() / 2**20:,.1f} MiB")
+            st.dataframe(memory.sort_values("raw_bytes", ascending=False))
+
+    st.write("### 📥 Order Queue")
+    order_stats = order_queue.metrics()
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Queued / in flight", f"{order_stats['queued']:,} / {order_stats['in_flight']:,}")
+    col2.metric("Placed / failed", f"{order_stats['placed']:,} / {order_stats['failed']:,}")
+    col3.metric("Retries / rejected", f"{order_stats['retries']:,} / {order_stats['rejected']:,}",
+                help=f"Duplicate submissions ignored: {order_stats['duplicates']:,}")
+    col4.metric("Latency p50 / p95",
+                f"{order_stats['p50_ms']:,.0f} / {order_stats['p95_ms']:,.0f} ms" if order_stats["p50_ms"] is not None else "-")
+
+    st.write("### 🐢 Slow Query Log")
+    for entry in reversed(slow_queries):
+        with st.expander(f"{entry['seconds'] * 1000:,.0f} ms · {entry['section']} · {entry['at']:%H:%M:%S}"):
+            st.code(entry["full_statement"], language="sql")
+            st.caption(f"Parameters: {entry['parameters']}")
+            if entry["plan"]:
+                st.code(entry["plan"])
@@ -0,0 +1,95 @@
+"""Bulk order uploads are grouped into orders, and an order with any invalid line is rejected whole.
+
+read_order_lines and group_order_lines are compiled on their own from the app's source,
+like the export helpers in test_exports.py.
+"""
+
+import ast
+import io
+import os
+
+import pandas as pd
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "streamlit.app.py")
+HELPERS = ("read_order_lines", "group_order_lines")
+
+
+def load_helpers():
+    with open(APP, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    nodes = [
+        node for node in tree.body
+        if (isinstance(node, ast.FunctionDef) and node.name in HELPERS)
+        or (isinstance(node, ast.Assign) and getattr(node.targets[0], "id", None) == "ORDER_LINE_COLUMNS")
+    ]
+    namespace = {"pd": pd}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), APP, "exec"), namespace)
+    return namespace
+
+
+HELPERS_NS = load_helpers()
+
+
+def upload(text, name="orders.csv"):
+    f = io.BytesIO(text.encode())
+    f.name = name
+    return f
+
+
+def group(text):
+    return HELPERS_NS["group_order_lines"](HELPERS_NS["read_order_lines"](upload(text)))
+
+
+def test_valid_lines_are_grouped_and_merged():
+    orders, failures = group("order_ref,customer_id,product_id,quantity\nA,1,7,2\nA,1,5,1\nA,1,7,1\nB,2,5,3\n")
+    assert failures == []
+    assert [(o["ref"], o["customer_id"], o["product_ids"], o["qtys"]) for o in orders] == [
+        ("A", 1, [5, 7], [1, 3]),
+        ("B", 2, [5], [3]),
+    ]
+
+
+def test_fractional_values_reject_the_whole_order():
+    orders, failures = group("order_ref,customer_id,product_id,quantity\nA,1,10.7,2.9\nA,1,5,1\nB,2,5,1\n")
+    assert [o["ref"] for o in orders] == ["B"]
+    assert failures == [{"order": "A", "customer_id": None,
+                         "error": "invalid customer_id, product_id or quantity on line 2"}]
+
+
+def test_fractional_quantities_are_not_summed_into_a_whole_one():
+    orders, failures = group("order_ref,customer_id,product_id,quantity\nA,1,5,0.4\nA,1,5,0.4\n")
+    assert orders == []
+    assert failures[0]["error"].endswith("on line 2, 3")
+
+
+def test_negative_and_zero_values_reject_the_order():
+    orders, failures = group(
+        "order_ref,customer_id,product_id,quantity\nA,1,5,-1\nB,2,-5,1\nC,-3,5,1\nD,4,5,0\nE,4,5,1\n"
+    )
+    assert [o["ref"] for o in orders] == ["E"]
+    assert [f["order"] for f in failures] == ["A", "B", "C", "D"]
+
+
+def test_mixed_customers_under_one_order_ref_are_rejected():
+    orders, failures = group("order_ref,customer_id,product_id,quantity\nA,1,5,1\nA,2,6,1\n")
+    assert orders == []
+    assert failures == [{"order": "A", "customer_id": None, "error": "order lines belong to different customers"}]
+
+
+def test_line_numbers_count_the_csv_header():
+    # Without order_ref, an order is a run of lines for one customer and is named by its first line
+    orders, failures = group("customer_id,product_id,quantity\n1,5,1\n1,6,1\n2,5,x\n3,5,1\n")
+    assert [o["ref"] for o in orders] == ["line 2", "line 5"]
+    assert failures == [{"order": "line 4", "customer_id": None,
+                         "error": "invalid customer_id, product_id or quantity on line 4"}]
+
+
+def test_parquet_lines_count_from_one(tmp_path):
+    path = tmp_path / "orders.parquet"
+    pd.DataFrame({"customer_id": [1, 2], "product_id": [5, 5], "quantity": [1, 0]}).to_parquet(path)
+    with open(path, "rb") as f:
+        f = io.BytesIO(f.read())
+    f.name = "orders.parquet"
+    orders, failures = HELPERS_NS["group_order_lines"](HELPERS_NS["read_order_lines"](f))
+    assert [o["ref"] for o in orders] == ["line 1"]
+    assert failures[0]["order"] == "line 2"